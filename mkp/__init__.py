@@ -1,14 +1,36 @@
-import ast
+import errno
+import functools
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
 import io
 import json
+import logging
+import multiprocessing
+import multiprocessing.context
 import os
 import os.path
-import pprint
+import posixpath
 import tarfile
 import re
-from typing import List, Tuple, Dict, Any, Union
+import stat
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Tuple, Dict, Any, Union, BinaryIO, Iterator, Optional, NamedTuple, Iterable, Callable
 
+from ._cache import BuildCache
+from ._gzip import IndexedGzipReader, ParallelGzipWriter
+from ._ignore import IgnoreRules, State as IgnoreState
+from ._literal import MAX_DEPTH, MAX_SIZE, parse_literal
+from ._manifest import FileMetadata, Manifest
+from ._memory import MemoryReader, map_file
+from ._pipeline import BackgroundIterator, ThreadedWriter
 from ._version import get_versions
+from ._watch import wait_for_changes
 
 __version__ = get_versions()['version']
 del get_versions
@@ -41,14 +63,42 @@ class IncludeAll:
 
 INCLUDE_ALL = IncludeAll()
 
+# pass as cache to dist to key cached directory archives on the content of the files as well
+CACHE_HASH_CONTENTS = 'hash'
+
+_LOGGER = logging.getLogger(__name__)
+_copy_buffers = threading.local()
+
 _VERSION_PACKAGED = 'python-mkp'
 _DIST_DIR = 'dist'
+_CACHE_DIR = '.cache'
+_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+_COMPRESS_LEVEL = 9
+_LARGE_FILE_SIZE = 1024 * 1024
+_COPY_BUFFER_SIZE = 1024 * 1024
+_COPY_UNSUPPORTED_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+_WATCH_ENVIRONMENT_VARIABLE = 'MKP_WATCH'
+_WATCH_POLL_INTERVAL = 0.5
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+_PIPELINE_DEPTH = 4
+_READ_AHEAD_BYTES = 16 * 1024 * 1024
+_METADATA_MEMBERS = ('info', 'info.json')
+_MAX_LINK_DEPTH = 16
 
 
 def dist(info: Dict[str, Any],
          path: str = None,
          directories: Union[List[str], IncludeAll] = DIRECTORIES,
-         exclude_patterns: List[str] = None):
+         exclude_patterns: List[str] = None,
+         jobs: int = 1,
+         cache: Union[bool, str] = False,
+         reproducible: bool = False,
+         skip_unchanged: bool = False,
+         watch: bool = None,
+         debounce: float = 0.5,
+         pipeline: bool = False,
+         read_ahead: int = 0,
+         read_ahead_bytes: int = _READ_AHEAD_BYTES):
     if exclude_patterns is None:
         exclude_patterns = []
 
@@ -56,133 +106,906 @@ def dist(info: Dict[str, Any],
         import __main__ as main
         path = os.path.dirname(os.path.realpath(main.__file__))
 
-    info['files'] = find_files(path, directories=directories, exclude_patterns=exclude_patterns)
+    if watch is None:
+        watch = bool(os.environ.get(_WATCH_ENVIRONMENT_VARIABLE))
+    if not watch:
+        _dist(info, path, directories, exclude_patterns, jobs=jobs, cache=cache, reproducible=reproducible,
+              skip_unchanged=skip_unchanged, pipeline=pipeline, read_ahead=read_ahead,
+              read_ahead_bytes=read_ahead_bytes)
+        return
+
+    _dist(info, path, directories, exclude_patterns, jobs=jobs, cache=cache or True, reproducible=reproducible,
+          skip_unchanged=skip_unchanged, pipeline=pipeline, read_ahead=read_ahead,
+          read_ahead_bytes=read_ahead_bytes)
+    watched_directories = None if isinstance(directories, IncludeAll) else list(directories)
+    _LOGGER.info('Watching %s for changes', path)
+    for changed in wait_for_changes(path, watched_directories, excluded={_DIST_DIR}, debounce=debounce,
+                                    poll_interval=_WATCH_POLL_INTERVAL):
+        _LOGGER.info('Rebuilding after changes in %s', ', '.join(sorted(changed)))
+        try:
+            _dist(info, path, directories, exclude_patterns, jobs=jobs, cache=cache or True,
+                  reproducible=reproducible, skip_unchanged=skip_unchanged, pipeline=pipeline, read_ahead=read_ahead,
+                  read_ahead_bytes=read_ahead_bytes)
+        except Exception:
+            _LOGGER.exception('Build failed')
+
+
+class DistReport(NamedTuple):
+    name: str
+    outfile: str
+    num_files: int
+    size: int
+    discovery_seconds: float
+    pack_seconds: float
+    skipped: bool
+
+
+def dist_many(specs: Iterable[Tuple[Dict[str, Any], str]],
+              jobs: int = None,
+              directories: Union[List[str], IncludeAll] = DIRECTORIES,
+              exclude_patterns: List[str] = None,
+              cache: Union[bool, str] = False,
+              reproducible: bool = False,
+              skip_unchanged: bool = False,
+              mp_context: multiprocessing.context.BaseContext = None) -> List[DistReport]:
+    """Build many packages like dist, given as (info, path) pairs, on a pool of jobs processes.
+
+    Files are discovered in the calling process, where trees shared by several packages are only walked once. With
+    jobs=1, the packages are built in the calling process.
+
+    The pool is started with mp_context. By default, processes are forked on Linux, and started with the default
+    start method of the platform elsewhere. Unless they are forked, the processes import the main module again, so
+    scripts calling dist_many there must guard the call with if __name__ == '__main__'.
+    """
+    if exclude_patterns is None:
+        exclude_patterns = []
+
+    discovery_cache = {}
+    discovered = []
+    for info, path in specs:
+        start = time.perf_counter()
+        entries = _discover(info, path, directories, exclude_patterns, discovery_cache,
+                            jobs=jobs or os.cpu_count() or 1)
+        discovered.append((info, path, entries, time.perf_counter() - start))
+
+    arguments = [(info, path, entries, discovery_seconds, 1, cache, reproducible, skip_unchanged)
+                 for info, path, entries, discovery_seconds in discovered]
+    if jobs == 1:
+        return [_dist_discovered(*args) for args in arguments]
+    if mp_context is None:
+        mp_context = _default_mp_context()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context) as executor:
+        futures = [executor.submit(_dist_discovered, *args) for args in arguments]
+        return [future.result() for future in futures]
+
+
+def _default_mp_context() -> multiprocessing.context.BaseContext:
+    if sys.platform.startswith('linux'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def _dist(info: Dict[str, Any], path: str, directories: Union[List[str], IncludeAll], exclude_patterns: List[str],
+          jobs: int, cache: Union[bool, str], reproducible: bool, skip_unchanged: bool, pipeline: bool = False,
+          read_ahead: int = 0, read_ahead_bytes: int = _READ_AHEAD_BYTES) -> DistReport:
+    start = time.perf_counter()
+    entries = _discover(info, path, directories, exclude_patterns, jobs=jobs)
+    return _dist_discovered(info, path, entries, time.perf_counter() - start, jobs, cache, reproducible,
+                            skip_unchanged, read_ahead, read_ahead_bytes, pipeline)
+
+
+def _discover(info: Dict[str, Any], path: str, directories: Union[List[str], IncludeAll], exclude_patterns: List[str],
+              discovery_cache: Dict = None, jobs: int = 1) -> Dict[str, List['_FileEntry']]:
+    entries = _find_files(path, directories, exclude_patterns, discovery_cache, jobs=jobs)
+    info['files'] = _relpaths(entries)
     info['num_files'] = sum(len(file_list) for file_list in info['files'].values())
+    return entries
+
+
+def _dist_discovered(info: Dict[str, Any], path: str, entries: Dict[str, List['_FileEntry']],
+                     discovery_seconds: float, jobs: int, cache: Union[bool, str], reproducible: bool,
+                     skip_unchanged: bool, read_ahead: int = 0, read_ahead_bytes: int = _READ_AHEAD_BYTES,
+                     pipeline: bool = False) -> DistReport:
+    start = time.perf_counter()
+    outfile, fingerprint_file = _dist_files(info, path)
+    skipped = False
+    if skip_unchanged:
+        fingerprint = _fingerprint(info, entries, reproducible)
+        skipped = os.path.exists(outfile) and _read_fingerprint(fingerprint_file) == fingerprint
+    if not skipped and os.path.exists(fingerprint_file):
+        os.unlink(fingerprint_file)
+
+    if skipped:
+        _LOGGER.info('%s is up to date', outfile)
+    else:
+        build_cache = _open_build_cache(info, path, cache) if cache else None
+        with _open_for_replace(outfile) as f:
+            _pack(info, path, f, _pack_options(jobs, build_cache, reproducible, read_ahead, read_ahead_bytes, pipeline),
+                  entries)
+        if build_cache:
+            _close_build_cache(build_cache)
+        if skip_unchanged:
+            with open(fingerprint_file, 'w') as f:
+                f.write(fingerprint)
+        _LOGGER.info('Wrote %s', outfile)
+
+    return DistReport(name=info['name'], outfile=outfile, num_files=info['num_files'],
+                      size=os.path.getsize(outfile), discovery_seconds=discovery_seconds,
+                      pack_seconds=time.perf_counter() - start, skipped=skipped)
+
+
+def _dist_files(info: Dict[str, Any], path: str) -> Tuple[str, str]:
+    """Return the paths of the package file and of its fingerprint file, creating the dist directory if needed."""
     dist_dir = os.path.join(path, _DIST_DIR)
     filename = '{}-{}.mkp'.format(info['name'], info['version'])
 
     if not os.path.exists(dist_dir):
-        os.makedirs(dist_dir)
+        os.makedirs(dist_dir, exist_ok=True)
+
+    return os.path.join(dist_dir, filename), os.path.join(dist_dir, '.{}.fingerprint'.format(filename))
+
+
+@contextlib.contextmanager
+def _open_for_replace(outfile: str) -> Iterator[BinaryIO]:
+    """Open a temporary file next to outfile for writing, which replaces outfile only if the block succeeds."""
+    directory, filename = os.path.split(outfile)
+    tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(filename, os.urandom(4).hex()))
+    try:
+        with open(tmp_path, 'xb') as f:
+            yield f
+        os.replace(tmp_path, outfile)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _open_build_cache(info: Dict[str, Any], path: str, cache: Union[bool, str]) -> BuildCache:
+    if cache not in (True, CACHE_HASH_CONTENTS):
+        raise ValueError('invalid cache mode {!r}'.format(cache))
+    return BuildCache(os.path.join(path, _DIST_DIR, _CACHE_DIR, info['name']),
+                      hash_contents=cache == CACHE_HASH_CONTENTS)
+
+
+def _close_build_cache(build_cache: BuildCache) -> None:
+    build_cache.prune()
+    _LOGGER.info('Build cache: %d hits, %d misses', build_cache.hits, build_cache.misses)
+
+
+def _fingerprint(info: Dict[str, Any], entries: Dict[str, List['_FileEntry']], reproducible: bool) -> str:
+    digest = hashlib.sha256()
+    source_date_epoch = os.environ.get('SOURCE_DATE_EPOCH') if reproducible else None
+    digest.update(json.dumps([__version__, reproducible, source_date_epoch, info], sort_keys=True).encode())
+    for directory, directory_entries in entries.items():
+        for entry in directory_entries:
+            digest.update(json.dumps([directory, entry.relpath, entry.size, entry.mtime_ns, entry.mode]).encode())
+    return digest.hexdigest()
+
 
-    pack_to_file(info, path, os.path.join(dist_dir, filename))
+def _read_fingerprint(fingerprint_file: str) -> Optional[str]:
+    try:
+        with open(fingerprint_file) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
 
 
-def find_files(path: str, directories: List[str] = DIRECTORIES, exclude_patterns: List[str] = None):
+def find_files(path: str, directories: List[str] = DIRECTORIES, exclude_patterns: List[str] = None, jobs: int = 1):
     if exclude_patterns is None:
         exclude_patterns = []
-    result = {}
+    return _relpaths(_find_files(path, directories, exclude_patterns, jobs=jobs))
+
+
+def find_manifest(path: str, directories: List[str] = DIRECTORIES, exclude_patterns: List[str] = None,
+                  jobs: int = 1) -> Manifest:
+    """Like find_files, but return a Manifest that also holds the size and mode of every file."""
+    if exclude_patterns is None:
+        exclude_patterns = []
+    manifest = Manifest()
+    for directory, entries in _iter_find_files(path, directories, exclude_patterns, jobs=jobs):
+        for entry in entries:
+            manifest.add(directory, entry.relpath, size=entry.size, mode=entry.mode)
+    return manifest
+
+
+class _FileEntry(NamedTuple):
+    relpath: str
+    size: int
+    mode: int
+    mtime_ns: int
+    uid: int
+    gid: int
+    inode: int
+    device: int
+    nlink: int
+
+
+def _file_entry(relpath: str, st: os.stat_result) -> _FileEntry:
+    return _FileEntry(relpath, st.st_size, st.st_mode, st.st_mtime_ns, st.st_uid, st.st_gid, st.st_ino, st.st_dev,
+                      st.st_nlink)
+
+
+def _stat_files(path: str, files: List[str]) -> List[_FileEntry]:
+    return [_file_entry(filename, os.lstat(os.path.join(path, filename))) for filename in files]
+
 
+def _relpaths(entries: Dict[str, List[_FileEntry]]) -> Dict[str, List[str]]:
+    return {directory: [entry.relpath for entry in directory_entries]
+            for directory, directory_entries in entries.items()}
+
+
+def _find_files(path: str, directories: Union[List[str], IncludeAll], exclude_patterns: List[str],
+                discovery_cache: Dict = None, jobs: int = 1) -> Dict[str, List[_FileEntry]]:
+    """Implementation of find_files, returning the lstat results of the files along with their paths.
+
+    Results per directory are stored in and taken from discovery_cache, if given."""
+    return dict(_iter_find_files(path, directories, exclude_patterns, discovery_cache, jobs))
+
+
+def _iter_find_files(path: str, directories: Union[List[str], IncludeAll], exclude_patterns: List[str],
+                     discovery_cache: Dict = None, jobs: int = 1) -> Iterator[Tuple[str, List[_FileEntry]]]:
+    """Like _find_files, but yield every non-empty directory with its files as soon as it is scanned.
+
+    With jobs > 1, all directories are scanned concurrently before the first one is yielded."""
     if isinstance(directories, IncludeAll):
         directories = [d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)) and not d.startswith('.')
                        and not d == _DIST_DIR]
     elif _DIST_DIR in directories:
         raise ValueError('Directory list cannot include "dist"')
 
-    for directory in directories:
+    ignore_rules = IgnoreRules.load(path)
+    found = {}
+    to_scan = {}
+    for directory in dict.fromkeys(directories):
         assert directory != _DIST_DIR, "The dist directory cannot be included in the package files."
-        files = _find_files_in_directory(os.path.join(path, directory), exclude_patterns=exclude_patterns)
-        if files:
-            result[directory] = files
+        ignore_state = None
+        if ignore_rules:
+            ignore_state, ignored = ignore_rules.step(ignore_rules.initial_state, directory, is_dir=True)
+            if ignored:
+                continue
+        cache_key = (os.path.abspath(os.path.join(path, directory)), tuple(exclude_patterns))
+        if discovery_cache is not None and cache_key in discovery_cache:
+            found[directory] = discovery_cache[cache_key]
+        else:
+            to_scan[directory] = (cache_key, ignore_state)
 
-    return result
+    if jobs > 1 and to_scan:
+        scan_directories = [(directory, ignore_state) for directory, (_, ignore_state) in to_scan.items()]
+        found.update(_find_files_concurrently(path, scan_directories, _compile_exclude_patterns(exclude_patterns),
+                                              ignore_rules, jobs))
+
+    for directory in dict.fromkeys(directories):
+        if directory in to_scan:
+            cache_key, ignore_state = to_scan[directory]
+            if directory not in found:
+                found[directory] = _find_files_in_directory(os.path.join(path, directory),
+                                                            exclude_patterns=exclude_patterns,
+                                                            ignore_rules=ignore_rules, ignore_state=ignore_state)
+            if discovery_cache is not None:
+                discovery_cache[cache_key] = found[directory]
+        if found.get(directory):
+            yield directory, list(found[directory])
+
+
+def _find_files_concurrently(path: str, directories: List[Tuple[str, Optional[IgnoreState]]],
+                             is_excluded: Optional[Callable[[str], bool]], ignore_rules: Optional[IgnoreRules],
+                             jobs: int) -> Dict[str, List[_FileEntry]]:
+    """Scan the directories on a thread pool: first their top levels, then every first-level subtree on its own.
+
+    The results are merged in the same order as _scan_directory produces them."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        top_levels = [(directory, executor.submit(_scan_entries, os.path.join(path, directory), '', is_excluded,
+                                                  ignore_rules, ignore_state))
+                      for directory, ignore_state in directories]
+        subtrees = []
+        for directory, future in top_levels:
+            files, subdirectories = future.result()
+            subtrees.append((directory, files, [
+                executor.submit(_scan_subtree, subdirectory_path, prefix, is_excluded, ignore_rules, ignore_state)
+                for subdirectory_path, prefix, ignore_state in subdirectories]))
+        return {directory: files + [filename for future in futures for filename in future.result()]
+                for directory, files, futures in subtrees}
 
 
-def _find_files_in_directory(path: str, exclude_patterns: List[str]):
+def _find_files_in_directory(path: str, exclude_patterns: List[str], ignore_rules: IgnoreRules = None,
+                             ignore_state: IgnoreState = None) -> List[_FileEntry]:
+    return _scan_subtree(path, '', _compile_exclude_patterns(exclude_patterns), ignore_rules, ignore_state)
+
+
+def _compile_exclude_patterns(exclude_patterns: List[str]) -> Optional[Callable[[str], bool]]:
+    """Combine the exclude patterns into one regular expression, unless a pattern uses backreferences, which would be
+    renumbered by combining them."""
+    if not exclude_patterns:
+        return None
+    if not any(_BACKREFERENCE.search(pattern) for pattern in exclude_patterns):
+        try:
+            return re.compile('|'.join('(?:{})'.format(pattern) for pattern in exclude_patterns)).search
+        except re.error:
+            pass
+    compiled_patterns = [re.compile(pattern) for pattern in exclude_patterns]
+    return lambda abspath: any(pattern.search(abspath) for pattern in compiled_patterns)
+
+
+def _scan_subtree(path: str, prefix: str, is_excluded: Optional[Callable[[str], bool]],
+                  ignore_rules: Optional[IgnoreRules], ignore_state: Optional[IgnoreState]) -> List[_FileEntry]:
     result = []
-    for root, dirs, files in os.walk(path):
-        for dirname in dirs:
-            if dirname.startswith('.'):
-                dirs.remove(dirname)
-        for filename in files:
-            if filename.startswith('.'):
-                continue
-            elif filename.endswith('~'):
-                continue
-            abspath = os.path.join(root, filename)
-            relpath = os.path.relpath(abspath, start=path)
-            if any(re.search(pattern, abspath) for pattern in exclude_patterns):
-                continue
-            result.append(relpath)
+    _scan_directory(path, prefix, is_excluded, ignore_rules, ignore_state, result)
     return result
 
 
-def pack_to_file(info: Dict[str, Any], path: str, outfile: str) -> None:
-    with open(outfile, 'wb') as f:
-        f.write(pack_to_bytes(info, path))
+def _scan_directory(path: str, prefix: str, is_excluded: Optional[Callable[[str], bool]],
+                    ignore_rules: Optional[IgnoreRules], ignore_state: Optional[IgnoreState],
+                    result: List[_FileEntry]) -> None:
+    """Append the paths of all files below path to result, files of a directory before its subdirectories."""
+    files, subdirectories = _scan_entries(path, prefix, is_excluded, ignore_rules, ignore_state)
+    result.extend(files)
+    for subdirectory_path, subdirectory_prefix, child_state in subdirectories:
+        _scan_directory(subdirectory_path, subdirectory_prefix, is_excluded, ignore_rules, child_state, result)
 
 
-def pack_to_bytes(info: Dict[str, Any], path: str) -> bytes:
-    _patch_info(info)
-    bytes_io = io.BytesIO()
-    with tarfile.open(fileobj=bytes_io, mode='w:gz') as archive:
-        _add_to_archive(archive, 'info', encode_info(info))
-        _add_to_archive(archive, 'info.json', encode_info_json(info))
+def _scan_entries(path: str, prefix: str, is_excluded: Optional[Callable[[str], bool]],
+                  ignore_rules: Optional[IgnoreRules], ignore_state: Optional[IgnoreState]) \
+        -> Tuple[List[_FileEntry], List[Tuple[str, str, Optional[IgnoreState]]]]:
+    """List the files and the subdirectories to descend into of a single directory, both sorted by name.
 
-        for directory in info['files'].keys():
-            files = info['files'].get(directory, [])
-            if not files:
+    A subdirectory is not descended into if an exclude pattern matches its path with a trailing separator or if it is
+    ignored by the ignore rules."""
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError:
+        return [], []
+
+    files = []
+    subdirectories = []
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir():
+            if entry.is_symlink() or (is_excluded and is_excluded(entry.path + os.sep)):
                 continue
+            child_state = None
+            if ignore_rules:
+                child_state, ignored = ignore_rules.step(ignore_state, entry.name, is_dir=True)
+                if ignored:
+                    continue
+            subdirectories.append((entry.path, prefix + entry.name + '/', child_state))
+            continue
+        if entry.name.endswith('~'):
+            continue
+        if is_excluded and is_excluded(entry.path):
+            continue
+        if ignore_rules and ignore_rules.step(ignore_state, entry.name, is_dir=False)[1]:
+            continue
+        try:
+            files.append(_file_entry(prefix + entry.name, entry.stat(follow_symlinks=False)))
+        except FileNotFoundError:
+            continue
+
+    return files, subdirectories
+
+
+def pack_to_file(info: Dict[str, Any], path: str, outfile: str, jobs: int = 1, cache: BuildCache = None,
+                 reproducible: bool = False, read_ahead: int = 0, read_ahead_bytes: int = _READ_AHEAD_BYTES) -> None:
+    with open(outfile, 'wb') as f:
+        _pack(info, path, f, _pack_options(jobs, cache, reproducible, read_ahead, read_ahead_bytes))
 
-            directory_archive = _create_directory_archive(os.path.join(path, directory), files)
-            _add_to_archive(archive, directory + '.tar', directory_archive)
 
+def pack_to_bytes(info: Dict[str, Any], path: str, jobs: int = 1, cache: BuildCache = None,
+                  reproducible: bool = False, read_ahead: int = 0, read_ahead_bytes: int = _READ_AHEAD_BYTES) -> bytes:
+    bytes_io = io.BytesIO()
+    _pack(info, path, bytes_io, _pack_options(jobs, cache, reproducible, read_ahead, read_ahead_bytes))
     return bytes_io.getvalue()
 
 
+def pack_to_stream(info: Dict[str, Any], path: str, fileobj: BinaryIO, jobs: int = 1, cache: BuildCache = None,
+                   reproducible: bool = False, read_ahead: int = 0, read_ahead_bytes: int = _READ_AHEAD_BYTES) -> None:
+    """Write the package to a writable binary file object. The stream does not need to be seekable."""
+    _pack(info, path, fileobj, _pack_options(jobs, cache, reproducible, read_ahead, read_ahead_bytes))
+
+
+class _PackOptions(NamedTuple):
+    jobs: int
+    cache: Optional[BuildCache]
+    # timestamp of all entries and of the gzip header in reproducible mode, None otherwise
+    mtime: Optional[int]
+    # number of threads reading small files ahead of the tar writer, 0 to read them when they are added
+    read_ahead: int = 0
+    # maximum number of bytes read ahead per directory archive
+    read_ahead_bytes: int = _READ_AHEAD_BYTES
+    # build the directory archives in a thread of their own and compress in another one
+    pipeline: bool = False
+
+
+def _pack_options(jobs: int, cache: Optional[BuildCache], reproducible: bool, read_ahead: int = 0,
+                  read_ahead_bytes: int = _READ_AHEAD_BYTES, pipeline: bool = False) -> _PackOptions:
+    mtime = int(os.environ.get('SOURCE_DATE_EPOCH', 0)) if reproducible else None
+    return _PackOptions(jobs=jobs, cache=cache, mtime=mtime, read_ahead=read_ahead,
+                        read_ahead_bytes=read_ahead_bytes, pipeline=pipeline)
+
+
+def _pack(info: Dict[str, Any], path: str, fileobj: BinaryIO, options: _PackOptions,
+          entries: Dict[str, List[_FileEntry]] = None) -> None:
+    """Pack the files listed in info. The lstat results of the files are taken from entries, if given.
+
+    With options.pipeline, the directory archives are built in a background thread, at most _PIPELINE_DEPTH archives
+    ahead of the tar writer, while compression runs in a thread of its own. The package is the same either way."""
+    _prepare_info(info, options)
+    directory_archives = _create_directory_archives(path, info['files'], entries, options)
+    if not options.pipeline:
+        _write_package(info, directory_archives, fileobj, options)
+        return
+    with BackgroundIterator(directory_archives, maxsize=_PIPELINE_DEPTH,
+                            discard=lambda directory_archive: directory_archive[1].close()) as background_archives:
+        _write_package(info, background_archives, fileobj, options, threaded=True)
+
+
+def _prepare_info(info: Dict[str, Any], options: _PackOptions) -> None:
+    _patch_info(info)
+    if isinstance(info['files'], Manifest):
+        info['files'] = info['files'].to_dict()
+    if options.mtime is not None:
+        info['files'] = {directory: sorted(info['files'][directory]) for directory in sorted(info['files'])}
+
+
+def _write_package(info: Dict[str, Any], directory_archives: Iterable[Tuple[str, BinaryIO]], fileobj: BinaryIO,
+                   options: _PackOptions, threaded: bool = False) -> None:
+    """Write the package from info and the directory archives. With threaded, compression runs in its own thread."""
+    with contextlib.ExitStack() as stack:
+        target = stack.enter_context(_open_compressor(fileobj, options))
+        if threaded:
+            target = stack.enter_context(ThreadedWriter(target, maxsize=_PIPELINE_DEPTH))
+        archive = stack.enter_context(tarfile.open(fileobj=target, mode='w'))
+
+        sorted_info = _sort_dicts(info)
+        _add_to_archive(archive, 'info', _encode_sorted_info(sorted_info), options)
+        _add_to_archive(archive, 'info.json', encode_info_json(sorted_info if options.mtime is not None else info),
+                        options)
+
+        for directory, directory_archive in directory_archives:
+            with directory_archive:
+                _add_file_to_archive(archive, directory + '.tar', directory_archive, options)
+
+
+def _open_compressor(fileobj: BinaryIO, options: _PackOptions) -> BinaryIO:
+    if options.jobs > 1:
+        return ParallelGzipWriter(fileobj, options.jobs, compresslevel=_COMPRESS_LEVEL, mtime=options.mtime)
+    return gzip.GzipFile(filename='', mode='wb', compresslevel=_COMPRESS_LEVEL, fileobj=fileobj, mtime=options.mtime)
+
+
 def _patch_info(info: Dict[str, Any]) -> None:
     info['version.packaged'] = _VERSION_PACKAGED
 
 
-def _create_directory_archive(path: str, files: List[str]) -> bytes:
-    bytes_io = io.BytesIO()
-    with tarfile.open(fileobj=bytes_io, mode='w') as archive:
-        for filename in files:
-            archive.add(os.path.join(path, filename), arcname=filename)
+def _create_directory_archives(path: str, files: Dict[str, List[str]], entries: Optional[Dict[str, List[_FileEntry]]],
+                               options: _PackOptions) -> Iterator[Tuple[str, BinaryIO]]:
+    """Yield the directory archives in the order of files. With jobs > 1 they are built on a thread pool, at most
+    jobs archives ahead of the consumer."""
+    directories = [directory for directory in files.keys() if files.get(directory)]
+    if options.jobs <= 1:
+        for directory in directories:
+            yield directory, _create_directory_archive(os.path.join(path, directory), files[directory],
+                                                       entries and entries.get(directory), options)
+        return
 
-    return bytes_io.getvalue()
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        try:
+            for directory in directories:
+                pending.append((directory, executor.submit(_create_directory_archive, os.path.join(path, directory),
+                                                           files[directory], entries and entries.get(directory),
+                                                           options)))
+                if len(pending) > options.jobs:
+                    directory, future = pending.popleft()
+                    yield directory, future.result()
+            while pending:
+                directory, future = pending.popleft()
+                yield directory, future.result()
+        finally:
+            for _, future in pending:
+                if not future.cancel() and future.exception() is None:
+                    future.result().close()
+
+
+def _create_directory_archive(path: str, files: List[str], entries: Optional[List[_FileEntry]],
+                              options: _PackOptions) -> BinaryIO:
+    """Build the tar of one directory in a spool that moves to disk once it exceeds _SPOOL_MAX_SIZE.
+
+    The tar headers are created from entries, or from a single lstat per file if no entries are given, without user
+    and group name lookups."""
+    if entries is None:
+        entries = _stat_files(path, files)
+    if options.mtime is not None:
+        entries = sorted(entries, key=lambda entry: entry.relpath)
+
+    cache = options.cache
+    if cache:
+        key = cache.key(path, entries, variant=options.mtime)
+        cached_archive = cache.get(key)
+        if cached_archive:
+            return cached_archive
+
+    spool = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+    normalize = functools.partial(_normalize_tarinfo, mtime=options.mtime) if options.mtime is not None else None
+    hardlinks = {}
+    try:
+        with tarfile.open(fileobj=spool, mode='w') as archive, \
+                contextlib.closing(_read_ahead(path, entries, options)) as contents:
+            for entry, content in zip(entries, contents):
+                abspath = os.path.join(path, entry.relpath)
+                tarinfo = _tarinfo_from_entry(entry, abspath, hardlinks)
+                if tarinfo is None:
+                    archive.add(abspath, arcname=entry.relpath, filter=normalize)
+                    continue
+                if normalize:
+                    tarinfo = normalize(tarinfo)
+                if tarinfo.isreg() and tarinfo.size >= _LARGE_FILE_SIZE:
+                    with open(abspath, 'rb') as f:
+                        _add_large_file(archive, tarinfo, f)
+                elif tarinfo.isreg() and content is not None:
+                    archive.addfile(tarinfo, fileobj=io.BytesIO(content))
+                elif tarinfo.isreg():
+                    with open(abspath, 'rb') as f:
+                        archive.addfile(tarinfo, fileobj=f)
+                else:
+                    archive.addfile(tarinfo)
+        if cache:
+            cache.put(key, spool)
+    except BaseException:
+        spool.close()
+        raise
+
+    return spool
+
+
+def _read_ahead(path: str, entries: List[_FileEntry], options: _PackOptions) -> Iterator[Optional[bytes]]:
+    """Yield the content of every regular file below _LARGE_FILE_SIZE in entries and None for all other entries, in
+    the order of entries.
+
+    The contents are read on a pool of options.read_ahead threads, at most options.read_ahead_bytes ahead of the
+    consumer. Without read_ahead, only None is yielded and the consumer reads the files itself."""
+    if options.read_ahead <= 0:
+        for _ in entries:
+            yield None
+        return
+
+    upcoming = iter(entries)
+    entry = next(upcoming, None)
+    pending = collections.deque()
+    pending_bytes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.read_ahead) as executor:
+        try:
+            while pending or entry:
+                while entry and (not pending or pending_bytes + entry.size <= options.read_ahead_bytes):
+                    if stat.S_ISREG(entry.mode) and entry.size < _LARGE_FILE_SIZE:
+                        pending.append((executor.submit(_read_file, os.path.join(path, entry.relpath)), entry.size))
+                        pending_bytes += entry.size
+                    else:
+                        pending.append((None, 0))
+                    entry = next(upcoming, None)
+                future, size = pending.popleft()
+                pending_bytes -= size
+                yield future and future.result()
+        finally:
+            for future, _ in pending:
+                if future:
+                    future.cancel()
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _tarinfo_from_entry(entry: _FileEntry, abspath: str,
+                        hardlinks: Dict[Tuple[int, int], str]) -> Optional[tarfile.TarInfo]:
+    """Create the header for a regular file, hard link or symbolic link like TarFile.gettarinfo does, but without
+    another lstat and without user and group name lookups. Returns None for other file types."""
+    tarinfo = tarfile.TarInfo(entry.relpath)
+    tarinfo.mode = stat.S_IMODE(entry.mode)
+    tarinfo.mtime = entry.mtime_ns // 1000000000
+    tarinfo.uid = entry.uid
+    tarinfo.gid = entry.gid
+    if stat.S_ISREG(entry.mode):
+        if entry.nlink > 1:
+            inode = (entry.inode, entry.device)
+            if inode in hardlinks:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = hardlinks[inode]
+                return tarinfo
+            hardlinks[inode] = entry.relpath
+        tarinfo.size = entry.size
+    elif stat.S_ISLNK(entry.mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(abspath)
+    else:
+        return None
+    return tarinfo
+
+
+def _add_large_file(archive: tarfile.TarFile, tarinfo: tarfile.TarInfo, source: BinaryIO) -> None:
+    """Add a member like TarFile.addfile, but copy the payload with _copy_payload instead of small read/write calls."""
+    header = tarinfo.tobuf(archive.format, archive.encoding, archive.errors)
+    archive.fileobj.write(header)
+    archive.offset += len(header)
+    _copy_payload(source, archive.fileobj, tarinfo.size)
+    blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+    if remainder:
+        archive.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    archive.offset += blocks * tarfile.BLOCKSIZE
+    archive.members.append(tarinfo)
+
+
+def _copy_payload(source: BinaryIO, target: BinaryIO, size: int) -> None:
+    """Copy size bytes from source to target.
 
+    Payloads that will not fit into the in-memory part of a spool are copied by the kernel with copy_file_range or
+    sendfile, if available. Everything else is copied through a reusable per-thread buffer."""
+    if size >= _SPOOL_MAX_SIZE and isinstance(target, tempfile.SpooledTemporaryFile) and _copy_file_descriptors(
+            source, target, size):
+        return
 
-def _add_to_archive(archive: tarfile.TarFile, filename: str, data: bytes) -> None:
-    tarinfo, file_object = _create_tarinfo_and_buffer(data, filename)
-    archive.addfile(tarinfo, fileobj=file_object)
+    buffer = getattr(_copy_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _copy_buffers.buffer = memoryview(bytearray(_COPY_BUFFER_SIZE))
+    readinto = getattr(source, 'readinto', None)
+    remaining = size
+    while remaining:
+        chunk = buffer[:min(remaining, _COPY_BUFFER_SIZE)]
+        if readinto:
+            length = readinto(chunk)
+        else:
+            data = source.read(len(chunk))
+            length = len(data)
+            chunk[:length] = data
+        if not length:
+            raise OSError('unexpected end of data')
+        target.write(chunk[:length])
+        remaining -= length
 
 
-def _create_tarinfo_and_buffer(data: bytes, filename: str) -> Tuple[tarfile.TarInfo, io.BytesIO]:
+def _copy_file_descriptors(source: BinaryIO, target: tempfile.SpooledTemporaryFile, size: int) -> bool:
+    """Copy size bytes from the current position of source to the current position of target in the kernel. Returns
+    False if neither copy_file_range nor sendfile is supported for the files."""
+    try:
+        source_fd = source.fileno()
+    except io.UnsupportedOperation:
+        return False
+    target.flush()
+    target_fd = target.fileno()  # moves the spool to disk
+    source_offset = source.tell()
+    target_offset = target.tell()
+    for copy in (_copy_with_copy_file_range, _copy_with_sendfile):
+        try:
+            if not copy(source_fd, target_fd, source_offset, target_offset, size):
+                continue
+        except OSError as e:
+            if e.errno in _COPY_UNSUPPORTED_ERRORS:
+                continue
+            raise
+        source.seek(source_offset + size)
+        target.seek(target_offset + size)
+        return True
+    return False
+
+
+def _copy_with_copy_file_range(source_fd: int, target_fd: int, source_offset: int, target_offset: int,
+                               size: int) -> bool:
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    while copied < size:
+        length = os.copy_file_range(source_fd, target_fd, size - copied, source_offset + copied,
+                                    target_offset + copied)
+        if not length:
+            raise OSError('unexpected end of data')
+        copied += length
+    return True
+
+
+def _copy_with_sendfile(source_fd: int, target_fd: int, source_offset: int, target_offset: int, size: int) -> bool:
+    if not hasattr(os, 'sendfile'):
+        return False
+    os.lseek(target_fd, target_offset, os.SEEK_SET)
+    copied = 0
+    while copied < size:
+        length = os.sendfile(target_fd, source_fd, source_offset + copied, size - copied)
+        if not length:
+            raise OSError('unexpected end of data')
+        copied += length
+    return True
+
+
+def _normalize_tarinfo(tarinfo: tarfile.TarInfo, mtime: int) -> tarfile.TarInfo:
+    tarinfo.mtime = mtime
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    if tarinfo.isreg():
+        tarinfo.mode = 0o755 if tarinfo.mode & 0o111 else 0o644
+    return tarinfo
+
+
+def _add_file_to_archive(archive: tarfile.TarFile, filename: str, file_object: BinaryIO,
+                         options: _PackOptions) -> None:
+    tarinfo = _create_tarinfo(filename, file_object.seek(0, io.SEEK_END), options)
+    file_object.seek(0)
+    _add_large_file(archive, tarinfo, file_object)
+
+
+def _add_to_archive(archive: tarfile.TarFile, filename: str, data: bytes, options: _PackOptions) -> None:
+    archive.addfile(_create_tarinfo(filename, len(data), options), fileobj=io.BytesIO(data))
+
+
+def _create_tarinfo(filename: str, size: int, options: _PackOptions) -> tarfile.TarInfo:
     tarinfo = tarfile.TarInfo(filename)
-    tarinfo.size = len(data)
-    bytes_io = io.BytesIO(data)
-    return tarinfo, bytes_io
+    tarinfo.size = size
+    if options.mtime is not None:
+        tarinfo.mtime = options.mtime
+    return tarinfo
 
 
 def encode_info(info: Dict[str, Any]) -> bytes:
-    return pprint.pformat(info).encode()
+    """Encode info as a Python literal with sorted keys and one top-level key per line, like pprint.pformat does.
+
+    The values are written with repr, which gives the same output on all supported Python versions for the types
+    used in info and takes time linear in the size of info."""
+    return _encode_sorted_info(_sort_dicts(info))
+
+
+def _encode_sorted_info(info: Dict[str, Any]) -> bytes:
+    return ('{' + ',\n '.join('{!r}: {!r}'.format(key, value) for key, value in info.items()) + '}').encode()
+
+
+def _sort_dicts(value: Any) -> Any:
+    """Copy the dicts in value with their keys sorted. Lists and tuples are copied only if they contain containers."""
+    if isinstance(value, dict):
+        return {key: _sort_dicts(value[key]) for key in sorted(value, key=_sort_key)}
+    if isinstance(value, (list, tuple)) and any(isinstance(item, (dict, list, tuple)) for item in value):
+        items = [_sort_dicts(item) for item in value]
+        return items if isinstance(value, list) else tuple(items)
+    return value
+
+
+def _sort_key(key: Any) -> Tuple[str, Any]:
+    return type(key).__name__, key
 
 
 def encode_info_json(info) -> bytes:
     return json.dumps(info).encode()
 
 
-def decode_info(info_bytes: bytes) -> Dict[str, Any]:
-    return ast.literal_eval(info_bytes.decode())
+def decode_info(info_bytes: bytes, max_size: int = MAX_SIZE, max_depth: int = MAX_DEPTH) -> Dict[str, Any]:
+    """Decode an info file with a restricted literal parser that rejects input longer than max_size characters or
+    nested deeper than max_depth with a ValueError."""
+    return parse_literal(info_bytes.decode(), max_size=max_size, max_depth=max_depth)
+
+
+def read_info(path: str, verify_info: bool = False) -> Dict[str, Any]:
+    """Read the info of the package file at path, decompressing only as much of the package as needed.
+
+    Like Package.info, it is decoded from info.json if present."""
+    with open(path, 'rb') as f:
+        return _decode_metadata(*_read_metadata(f), verify_info=verify_info)[0]
+
+
+def _read_metadata(fileobj: BinaryIO) -> Tuple[bytes, Optional[bytes]]:
+    """Read info and info.json in a forward pass over the package that stops as soon as both are read.
+
+    Packages written by this module or by Check_MK start with these members. For packages with a different member
+    order or without info.json, the pass covers the whole package."""
+    metadata = {}
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            if member.name in _METADATA_MEMBERS and member.name not in metadata:
+                metadata[member.name] = archive.extractfile(member).read()
+                if len(metadata) == len(_METADATA_MEMBERS):
+                    break
+    if 'info' not in metadata:
+        raise KeyError("filename 'info' not found")
+    return metadata['info'], metadata.get('info.json')
+
+
+def _decode_metadata(info_bytes: bytes, json_bytes: Optional[bytes],
+                     verify_info: bool) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """Decode the metadata, preferring info.json over info. With verify_info, info is decoded as well and must match
+    info.json."""
+    if json_bytes is None:
+        return decode_info(info_bytes), None
+    json_info = json.loads(json_bytes)
+    if verify_info and json.loads(json.dumps(decode_info(info_bytes))) != json_info:
+        raise ValueError('info.json does not match info')
+    return json_info, json_info
 
 
 class Package(object):
 
-    def __init__(self, fileobj):
-        self.archive = tarfile.open(fileobj=fileobj)
-        self._info = self._get_info()
-        self._json_info = self._get_json_info()
+    def __init__(self, fileobj, lazy: bool = False, verify_info: bool = False, indexed: bool = False):
+        """Read the package from the seekable fileobj. The metadata is read in a forward pass that stops once info
+        and info.json are read. The archive is opened right away, or in lazy mode on first access.
 
-    def _get_info(self):
-        info_file = self.archive.extractfile('info')
-        return decode_info(info_file.read())
+        With indexed, the gzip compressed package in the seekable fileobj is decompressed by an IndexedGzipReader,
+        so that seeking in the archive, e.g. by open and read, resumes decompression at the closest checkpoint.
 
-    def _get_json_info(self):
-        try:
-            info_file = self.archive.extractfile('info.json')
-            return json.loads(info_file.read())
-        except KeyError:
-            return None
+        The info is decoded from info.json if the package has one. With verify_info, it must match info. close does
+        not close fileobj."""
+        self._archive = None
+        self._manifest = None
+        # members of the directory archives by directory and name, with offsets into the uncompressed package
+        self._members = None
+        self._lock = threading.Lock()
+        # file objects and mappings opened for this package, closed by close
+        self._resources = []
+        if indexed:
+            fileobj = IndexedGzipReader(fileobj)
+            self._resources.append(fileobj)
+        self._fileobj = fileobj
+        self._offset = fileobj.tell()
+        self._info, self._json_info = _decode_metadata(*_read_metadata(fileobj), verify_info=verify_info)
+        if not lazy:
+            self._open_archive()
+
+    @property
+    def archive(self) -> tarfile.TarFile:
+        if self._archive is None:
+            self._open_archive()
+        return self._archive
+
+    def _open_archive(self) -> None:
+        self._fileobj.seek(self._offset)
+        self._archive = tarfile.open(fileobj=self._fileobj)
+
+    def open(self, directory: str, relpath: str) -> BinaryIO:
+        """Open a file of the package for reading without extracting it. Links within directory are followed.
+
+        The first call indexes the members of all directory archives in one pass over the package; later calls only
+        decompress the requested file."""
+        member = self._find_member(directory, relpath)
+        return _SectionReader(self.archive.fileobj, member.offset_data, member.size, self._lock)
+
+    def read(self, directory: str, relpath: str) -> bytes:
+        with self.open(directory, relpath) as f:
+            return f.read()
+
+    def _find_member(self, directory: str, relpath: str) -> tarfile.TarInfo:
+        with self._lock:
+            if self._members is None:
+                self._members = _index_directory_members(self.archive.fileobj)
+        members = self._members.get(directory, {})
+        for _ in range(_MAX_LINK_DEPTH):
+            member = members.get(relpath)
+            if member is None:
+                raise KeyError('{}/{} not found'.format(directory, relpath))
+            if member.isreg():
+                return member
+            if member.islnk():
+                relpath = member.linkname
+            elif member.issym():
+                relpath = posixpath.normpath(posixpath.join(posixpath.dirname(relpath), member.linkname))
+            else:
+                raise ValueError('{}/{} is not a regular file'.format(directory, relpath))
+        raise ValueError('{}/{}: too many levels of links'.format(directory, relpath))
+
+    def iter_files(self) -> Iterator[Tuple[str, str, tarfile.TarInfo, Optional[BinaryIO]]]:
+        """Like mkp.iter_files, but for this package; the archive is decompressed once more from the start.
+
+        The package must not be read otherwise until the iteration is complete."""
+        stream = self.archive.fileobj
+        stream.seek(0)
+        return iter_files(stream)
+
+    def close(self) -> None:
+        if self._archive is not None:
+            self._archive.close()
+        for resource in reversed(self._resources):
+            resource.close()
+        self._resources = []
+
+    def __enter__(self) -> 'Package':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
     @property
     def info(self):
@@ -192,30 +1015,172 @@ class Package(object):
     def json_info(self) -> Dict[str, Any]:
         return self._json_info
 
+    @property
+    def manifest(self) -> Manifest:
+        """The files listed in info, built on first access."""
+        if self._manifest is None:
+            self._manifest = Manifest.from_dict(self.info['files'])
+        return self._manifest
+
     def extract_files(self, path: str):
-        for directory in self.info['files'].keys():
-            self._extract_files_in_directory(path, directory)
+        """Extract the files listed in info to path, in a single forward pass over the package.
+
+        The package is decompressed exactly once, so the time taken grows linearly with the size of the package."""
+        stream = self.archive.fileobj
+        stream.seek(0)
+        extracted = set()
+        for directory, _, directory_archive in _iter_directory_archives(stream):
+            if not self.info['files'].get(directory) or directory in extracted:
+                continue
+            extracted.add(directory)
+            self._extract_files_in_directory(os.path.join(path, directory), directory, directory_archive)
+        for directory, files in self.info['files'].items():
+            if files and directory not in extracted:
+                raise KeyError("filename '{}.tar' not found".format(directory))
+
+    def _extract_files_in_directory(self, target_path: str, directory: str, archive: tarfile.TarFile):
+        os.makedirs(target_path)
+        for member in _iter_members(archive):
+            if self.manifest.contains(directory, member.name):
+                archive.extract(member, path=target_path)
+
+
+def iter_files(fileobj: BinaryIO) -> Iterator[Tuple[str, str, tarfile.TarInfo, Optional[BinaryIO]]]:
+    """Iterate over the files of the package in fileobj in a single forward pass, without extracting them.
+
+    Yields (directory, relpath, tarinfo, file object) in package order. fileobj may be compressed and does not need
+    to be seekable, e.g. stdin or a socket. The file object of a file can only be read until the next file is
+    yielded. Links are yielded with None instead of a file object; tarinfo holds their type and target. Members are
+    not retained, so memory use does not grow with the number of files."""
+    for directory, _, directory_archive in _iter_directory_archives(fileobj):
+        for member in _iter_members(directory_archive):
+            if not member.isdir():
+                file_object = directory_archive.extractfile(member) if member.isreg() else None
+                yield directory, member.name, member, file_object
 
-    def _extract_files_in_directory(self, path: str, directory: str):
-        files = self.info['files'].get(directory, [])
 
-        if not files:
+def _iter_directory_archives(fileobj: BinaryIO) -> Iterator[Tuple[str, tarfile.TarInfo, tarfile.TarFile]]:
+    """Open the directory archives in a forward pass over the package in fileobj, one after another.
+
+    Yields the directory, the member of its archive in the package, and the archive opened in stream mode."""
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in _iter_members(archive):
+            if not member.isreg() or not member.name.endswith('.tar') or member.name in _METADATA_MEMBERS:
+                continue
+            with tarfile.open(fileobj=archive.extractfile(member), mode='r|') as directory_archive:
+                yield member.name[:-len('.tar')], member, directory_archive
+
+
+def _iter_members(archive: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+    """Iterate over the members of an archive in stream mode without keeping them in archive.members."""
+    while True:
+        member = archive.next()
+        if member is None:
             return
+        archive.members.clear()
+        yield member
 
-        target_path = os.path.join(path, directory)
-        os.makedirs(target_path)
-        dir_archive_file = self.archive.extractfile(directory + '.tar')
 
-        with tarfile.open(fileobj=dir_archive_file) as archive:
-            members = [member for member in archive.getmembers() if member.name in files]
-            archive.extractall(path=target_path, members=members)
+def _index_directory_members(stream: BinaryIO) -> Dict[str, Dict[str, tarfile.TarInfo]]:
+    """Index the members of the directory archives in a forward pass over the uncompressed package in stream.
+
+    The offset_data of every member is changed to its absolute position in stream."""
+    stream.seek(0)
+    index = {}
+    for directory, member, directory_archive in _iter_directory_archives(stream):
+        members = index[directory] = {}
+        for directory_member in _iter_members(directory_archive):
+            directory_member.offset_data += member.offset_data
+            members[directory_member.name] = directory_member
+    return index
+
+
+class _SectionReader(io.RawIOBase):
+    """Read-only file object over size bytes at offset in a seekable stream shared with other readers."""
+
+    def __init__(self, stream: BinaryIO, offset: int, size: int, lock: threading.Lock):
+        super().__init__()
+        self._stream = stream
+        self._offset = offset
+        self._size = size
+        self._lock = lock
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        remaining = max(0, self._size - self._position)
+        length = remaining if size is None or size < 0 else min(size, remaining)
+        if not length:
+            return b''
+        with self._lock:
+            self._stream.seek(self._offset + self._position)
+            data = self._stream.read(length)
+        if len(data) < length:
+            raise OSError('unexpected end of data')
+        self._position += length
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        memoryview(buffer).cast('B')[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence ({})'.format(whence))
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
 
+def load_file(path: str, lazy: bool = False, verify_info: bool = False, use_mmap: bool = False,
+              indexed: bool = False) -> Package:
+    """Load the package file at path, which stays open until the package is closed.
 
-def load_file(path: str) -> Package:
+    With use_mmap, the file is mapped into memory and read from there, so packages that are loaded repeatedly share
+    the page cache instead of copying the file into buffers of their own."""
     file_io = open(path, 'rb')
-    return Package(file_io)
+    resources = [file_io]
+    try:
+        fileobj = file_io
+        mapped = map_file(file_io) if use_mmap else None
+        if mapped is not None:
+            resources.append(mapped)
+            fileobj = MemoryReader(mapped)
+            resources.append(fileobj)
+        package = Package(fileobj, lazy=lazy, verify_info=verify_info, indexed=indexed)
+    except BaseException:
+        for resource in reversed(resources):
+            resource.close()
+        raise
+    package._resources[:0] = resources
+    return package
 
 
-def load_bytes(data: bytes) -> Package:
-    bytes_io = io.BytesIO(data)
-    return Package(bytes_io)
+def load_bytes(data: Union[bytes, bytearray, memoryview], lazy: bool = False, verify_info: bool = False,
+               indexed: bool = False) -> Package:
+    """Load a package from a bytes-like object, without copying it."""
+    fileobj = io.BytesIO(data) if isinstance(data, bytes) else MemoryReader(data)
+    try:
+        package = Package(fileobj, lazy=lazy, verify_info=verify_info, indexed=indexed)
+    except BaseException:
+        fileobj.close()
+        raise
+    package._resources.insert(0, fileobj)
+    return package
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+from typing import Any, BinaryIO, List, Optional
+
+_CACHE_FORMAT = 2
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class BuildCache(object):
+    """Persistent cache of directory archives.
+
+    An archive is keyed on the directory name, its file list and the size, mtime, mode and ownership of every file.
+    With hash_contents, the key also covers the content of the files, which catches changes that keep size and
+    mtime.
+    """
+
+    def __init__(self, path: str, hash_contents: bool = False):
+        self.path = path
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+        self._used = set()
+        self._lock = threading.Lock()
+
+    def key(self, path: str, entries: List[Any], variant: Any = None) -> str:
+        """Compute the key of the archive of the directory path from the lstat results of its files."""
+        digest = hashlib.sha256()
+        digest.update(json.dumps([_CACHE_FORMAT, os.path.basename(path), variant]).encode())
+        for entry in entries:
+            key_entry = [entry.relpath, entry.size, entry.mtime_ns, entry.mode, entry.uid, entry.gid]
+            abspath = os.path.join(path, entry.relpath)
+            if stat.S_ISLNK(entry.mode):
+                key_entry.append(os.readlink(abspath))
+            elif entry.nlink > 1:
+                key_entry.extend([entry.inode, entry.device])
+            if self.hash_contents and stat.S_ISREG(entry.mode):
+                key_entry.append(_hash_file(abspath))
+            digest.update(json.dumps(key_entry).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[BinaryIO]:
+        try:
+            archive = open(self._entry_path(key), 'rb')
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                self._used.add(key)
+            return None
+        with self._lock:
+            self.hits += 1
+            self._used.add(key)
+        return archive
+
+    def put(self, key: str, archive: BinaryIO) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                archive.seek(0)
+                shutil.copyfileobj(archive, f)
+            os.replace(tmp_path, self._entry_path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        finally:
+            archive.seek(0)
+
+    def prune(self) -> None:
+        """Remove all entries that were not looked up through this instance."""
+        if not os.path.isdir(self.path):
+            return
+        for filename in os.listdir(self.path):
+            if filename.endswith('.tar') and filename[:-len('.tar')] not in self._used:
+                os.unlink(os.path.join(self.path, filename))
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key + '.tar')
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,216 @@
+import bisect
+import collections
+import concurrent.futures
+import io
+import struct
+import time
+import zlib
+from typing import Any, BinaryIO, List, NamedTuple, Optional
+
+_BLOCK_SIZE = 1024 * 1024
+_WINDOW_SIZE = 32 * 1024
+_GZIP_MAGIC = b'\x1f\x8b'
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_OS_UNKNOWN = 255
+_CHECKPOINT_SPACING = 1024 * 1024
+_READ_SIZE = 64 * 1024
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Write-only gzip file object that compresses blocks of the input on a thread pool.
+
+    Every block is compressed independently with the last 32 KiB of the preceding block as preset dictionary and
+    ends with a sync flush, so the joined blocks form one regular deflate stream in a single gzip member, just like
+    pigz does. zlib releases the GIL while compressing, so the blocks are compressed in parallel.
+    """
+
+    def __init__(self, fileobj: BinaryIO, jobs: int, compresslevel: int = 9, block_size: int = _BLOCK_SIZE,
+                 mtime: Optional[int] = None):
+        super().__init__()
+        self._fileobj = fileobj
+        self._compresslevel = compresslevel
+        self._block_size = block_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self._pending = collections.deque()
+        self._max_pending = 2 * jobs
+        self._buffer = bytearray()
+        self._dictionary = b''
+        self._crc = 0
+        self._size = 0
+        self._write_header(int(time.time()) if mtime is None else mtime)
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._size
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError('write to closed file')
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            block = bytes(self._buffer[:self._block_size])
+            del self._buffer[:self._block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+            self._fileobj.write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+        finally:
+            self._executor.shutdown()
+            super().close()
+
+    def _write_header(self, mtime: int) -> None:
+        extra_flags = 2 if self._compresslevel == 9 else 4 if self._compresslevel == 1 else 0
+        self._fileobj.write(_GZIP_MAGIC + struct.pack('<BBIBB', zlib.DEFLATED, 0, mtime, extra_flags, _OS_UNKNOWN))
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        future = self._executor.submit(_compress_block, block, self._dictionary, self._compresslevel, last)
+        self._dictionary = block[-_WINDOW_SIZE:]
+        self._pending.append(future)
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+
+def _compress_block(block: bytes, dictionary: bytes, compresslevel: int, last: bool) -> bytes:
+    if dictionary:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class _Checkpoint(NamedTuple):
+    offset: int
+    compressed_offset: int
+    decompressor: Any
+
+
+class IndexedGzipReader(io.RawIOBase):
+    """Seekable read-only file object over the uncompressed data of a gzip file.
+
+    While decompressing, the state of the decompressor is saved about every spacing bytes of uncompressed data, like
+    zran.c of zlib does. Seeking, backwards in particular, resumes decompression at the closest preceding checkpoint
+    instead of at the start of the file, as gzip.GzipFile does. Every checkpoint holds the 32 KiB window of the
+    decompressor. Checkpoints are kept in memory only, since decompressor states cannot be serialized. The reader is
+    not thread-safe; fileobj is not closed by close."""
+
+    def __init__(self, fileobj: BinaryIO, spacing: int = _CHECKPOINT_SPACING):
+        super().__init__()
+        start = fileobj.tell()
+        if fileobj.read(len(_GZIP_MAGIC)) != _GZIP_MAGIC:
+            raise ValueError('not a gzip file')
+        fileobj.seek(start)
+        self._fileobj = fileobj
+        self._spacing = spacing
+        self._checkpoints: List[_Checkpoint] = [_Checkpoint(0, start, zlib.decompressobj(_GZIP_WBITS))]
+        # uncompressed offsets of the checkpoints, for bisect
+        self._offsets = [0]
+        self._restore(self._checkpoints[0])
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        if self.closed:
+            raise ValueError('read from closed file')
+        self._move_to(self._position)
+        chunks = []
+        remaining = -1 if size is None or size < 0 else size
+        while remaining:
+            data = self._decompress(_READ_SIZE if remaining < 0 else min(remaining, _READ_SIZE))
+            if not data:
+                break
+            chunks.append(data)
+            if remaining > 0:
+                remaining -= len(data)
+        data = b''.join(chunks)
+        self._position += len(data)
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        memoryview(buffer).cast('B')[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            self._move_to(float('inf'))
+            offset += self._offset
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence ({})'.format(whence))
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+    def _move_to(self, position: float) -> None:
+        """Move the decompressor to position, or to the end of the data if position is beyond it."""
+        checkpoint = self._checkpoints[bisect.bisect_right(self._offsets, position) - 1]
+        if position < self._offset or checkpoint.offset > self._offset:
+            self._restore(checkpoint)
+        while self._offset < position:
+            if not self._decompress(int(min(position - self._offset, _READ_SIZE))):
+                break
+
+    def _restore(self, checkpoint: _Checkpoint) -> None:
+        self._fileobj.seek(checkpoint.compressed_offset)
+        self._decompressor = checkpoint.decompressor.copy()
+        self._offset = checkpoint.offset
+        # compressed data read from fileobj, but not passed to the decompressor yet
+        self._input = b''
+
+    def _decompress(self, size: int) -> bytes:
+        """Decompress at most size bytes at the current offset, returning an empty result only at the end of data."""
+        while True:
+            if not self._input:
+                self._input = self._fileobj.read(_READ_SIZE)
+                if not self._input:
+                    if self._decompressor.eof:
+                        return b''
+                    raise EOFError('compressed file ended before the end-of-stream marker was reached')
+            if self._decompressor.eof:
+                # a following gzip member, possibly after zero padding
+                self._input = self._input.lstrip(b'\0')
+                if not self._input:
+                    continue
+                self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+            data = self._decompressor.decompress(self._input, size)
+            if self._decompressor.eof:
+                self._input = self._decompressor.unused_data
+            else:
+                self._input = self._decompressor.unconsumed_tail
+            if data:
+                self._offset += len(data)
+                self._add_checkpoint()
+                return data
+
+    def _add_checkpoint(self) -> None:
+        if self._offset < self._offsets[-1] + self._spacing or self._decompressor.eof:
+            return
+        compressed_offset = self._fileobj.tell() - len(self._input)
+        self._checkpoints.append(_Checkpoint(self._offset, compressed_offset, self._decompressor.copy()))
+        self._offsets.append(self._offset)
@@ -0,0 +1,206 @@
+import os
+import re
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+
+IGNORE_FILE = '.mkpignore'
+
+_GLOB_CHARACTERS = re.compile(r'(?<!\\)[*?\[]')
+_TRAILING_SPACES = re.compile(r'(?<!\\) +$')
+_ESCAPE = re.compile(r'\\(.)')
+
+
+class _Node(object):
+    __slots__ = ('literals', 'suffixes', 'suffix_lengths', 'globs', 'glob_children', 'glob_filter', 'glob_matcher',
+                 'recursive', 'is_recursive', 'rules')
+
+    def __init__(self, is_recursive: bool = False):
+        self.literals: Dict[str, _Node] = {}
+        # children for globs like *.ext by their literal suffix, looked up by the distinct suffix lengths
+        self.suffixes: Dict[str, _Node] = {}
+        self.suffix_lengths: Tuple[int, ...] = ()
+        # children for all other globs by their pattern, matched by a single regex with a group per glob
+        self.globs: Dict[str, _Node] = {}
+        self.glob_children: List[_Node] = []
+        self.glob_filter: Optional[Callable[[str], Any]] = None
+        self.glob_matcher: Optional[Callable[[str], Any]] = None
+        self.recursive: Optional[_Node] = None
+        self.is_recursive = is_recursive
+        self.rules: List[Tuple[int, bool, bool]] = []
+
+    def compile(self) -> None:
+        self.suffix_lengths = tuple(sorted({len(suffix) for suffix in self.suffixes}))
+        if self.globs:
+            patterns = [_translate(glob) for glob in self.globs]
+            self.glob_children = list(self.globs.values())
+            self.glob_filter = re.compile('(?:{})'.format('|'.join(patterns)), re.DOTALL).fullmatch
+            # every glob is tested in a lookahead of its own, so that the groups of all matching globs are set
+            self.glob_matcher = re.compile(''.join(
+                r'(?:(?=(?P<g{}>{})\Z))?'.format(i, pattern) for i, pattern in enumerate(patterns)), re.DOTALL).match
+
+    def children(self, name: str) -> Iterator['_Node']:
+        child = self.literals.get(name)
+        if child:
+            yield child
+        for length in self.suffix_lengths:
+            if length > len(name):
+                break
+            child = self.suffixes.get(name[len(name) - length:])
+            if child:
+                yield child
+        if self.glob_filter and self.glob_filter(name):
+            for child, group in zip(self.glob_children, self.glob_matcher(name).groups()):
+                if group is not None:
+                    yield child
+
+
+State = FrozenSet[_Node]
+
+
+class IgnoreRules(object):
+    """Gitignore-style rules, compiled into a trie of path segments.
+
+    Matching walks the trie one path segment at a time while keeping the set of reachable nodes, so the cost of
+    matching a path depends on its depth and not on the number of rules: literal segments and globs like *.ext are
+    looked up in dicts, and the remaining globs of a trie node are matched by a single regex. As in git, the last matching rule wins and
+    files inside an ignored directory cannot be re-included.
+    """
+
+    def __init__(self, lines: Iterable[str]):
+        self._root = _Node()
+        for index, line in enumerate(lines):
+            self._add_rule(index, line)
+        self._compile()
+        self._initial_state = self._closure([self._root])
+
+    @classmethod
+    def load(cls, path: str) -> Optional['IgnoreRules']:
+        """Read the .mkpignore file in path, if there is one."""
+        try:
+            with open(os.path.join(path, IGNORE_FILE), encoding='utf-8') as f:
+                return cls(f.read().splitlines())
+        except FileNotFoundError:
+            return None
+
+    @property
+    def initial_state(self) -> State:
+        return self._initial_state
+
+    def step(self, state: State, name: str, is_dir: bool) -> Tuple[State, bool]:
+        """Descend from state into the path segment name. Returns the new state and whether the path is ignored."""
+        reached = []
+        for node in state:
+            reached.extend(node.children(name))
+            if node.is_recursive:
+                reached.append(node)
+        new_state = self._closure(reached)
+
+        decisive_rule = None
+        for node in new_state:
+            for rule in node.rules:
+                index, _, directory_only = rule
+                if (is_dir or not directory_only) and (decisive_rule is None or index > decisive_rule[0]):
+                    decisive_rule = rule
+        return new_state, decisive_rule is not None and not decisive_rule[1]
+
+    def match(self, relpath: str, is_dir: bool = False) -> bool:
+        """Check whether relpath, relative to the location of the rules, is ignored, including by its parents."""
+        state = self._initial_state
+        segments = relpath.strip('/').split('/')
+        for i, segment in enumerate(segments):
+            state, ignored = self.step(state, segment, is_dir or i < len(segments) - 1)
+            if ignored:
+                return True
+        return False
+
+    def _compile(self) -> None:
+        pending = [self._root]
+        while pending:
+            node = pending.pop()
+            node.compile()
+            pending.extend(node.literals.values())
+            pending.extend(node.suffixes.values())
+            pending.extend(node.globs.values())
+            if node.recursive:
+                pending.append(node.recursive)
+
+    @staticmethod
+    def _closure(nodes: Iterable[_Node]) -> State:
+        result = set()
+        pending = list(nodes)
+        while pending:
+            node = pending.pop()
+            if node in result:
+                continue
+            result.add(node)
+            if node.recursive:
+                pending.append(node.recursive)
+        return frozenset(result)
+
+    def _add_rule(self, index: int, line: str) -> None:
+        line = _TRAILING_SPACES.sub('', line)
+        if not line or line.startswith('#'):
+            return
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        directory_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            return
+        anchored = '/' in line
+        segments = [segment for segment in line.lstrip('/').split('/') if segment]
+        if not anchored:
+            segments.insert(0, '**')
+        if segments[-1] == '**':
+            segments[-1:] = ['*', '**']
+
+        node = self._root
+        previous = None
+        for segment in segments:
+            if segment == '**':
+                if previous == '**':
+                    continue
+                if not node.recursive:
+                    node.recursive = _Node(is_recursive=True)
+                node = node.recursive
+            elif segment.startswith('*') and not _GLOB_CHARACTERS.search(segment[1:]):
+                node = node.suffixes.setdefault(_ESCAPE.sub(r'\1', segment[1:]), _Node())
+            elif _GLOB_CHARACTERS.search(segment):
+                node = node.globs.setdefault(segment, _Node())
+            else:
+                node = node.literals.setdefault(_ESCAPE.sub(r'\1', segment), _Node())
+            previous = segment
+        node.rules.append((index, negate, directory_only))
+
+
+def _translate(segment: str) -> str:
+    i, n = 0, len(segment)
+    result = []
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == '\\' and i < n:
+            result.append(re.escape(segment[i]))
+            i += 1
+        elif c == '*':
+            result.append('.*')
+        elif c == '?':
+            result.append('.')
+        elif c == '[':
+            j = i
+            if j < n and segment[j] in '!^':
+                j += 1
+            if j < n and segment[j] == ']':
+                j += 1
+            j = segment.find(']', j)
+            if j < 0:
+                result.append(re.escape(c))
+                continue
+            body = segment[i:j].replace('\\', '\\\\')
+            if body[:1] in ('!', '^'):
+                body = '^' + body[1:]
+            result.append('[' + body + ']')
+            i = j + 1
+        else:
+            result.append(re.escape(c))
+    return ''.join(result)
@@ -0,0 +1,166 @@
+import re
+import unicodedata
+from typing import Any
+
+MAX_SIZE = 64 * 1024 * 1024
+MAX_DEPTH = 64
+
+_STRINGS = {
+    "'": re.compile(r"'([^'\\\n]*(?:\\.[^'\\\n]*)*)'", re.DOTALL),
+    '"': re.compile(r'"([^"\\\n]*(?:\\.[^"\\\n]*)*)"', re.DOTALL),
+}
+_NUMBER = re.compile(r'-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_NAME = re.compile(r'[A-Za-z_]\w*')
+_WHITESPACE = re.compile(r'\s*')
+# a list of single-quoted strings without escapes, like the file lists in info, is decoded by the regex engine alone
+_SIMPLE_STRING_LIST = re.compile(r"\[\s*((?:'[^'\\\n]*'\s*,\s*)*'[^'\\\n]*'\s*,?\s*)\]")
+_SIMPLE_STRING = re.compile(r"'([^'\\\n]*)'")
+_ESCAPE = re.compile(r'\\(?:x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|N\{[^}]*\}|[0-7]{1,3}|.)', re.DOTALL)
+_SIMPLE_ESCAPES = {
+    '\\': '\\', "'": "'", '"': '"', 'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v',
+    '\n': '',
+}
+_NAMES = {'None': None, 'True': True, 'False': False}
+_CLOSING = {'[': ']', '{': '}', '(': ')'}
+
+
+def parse_literal(text: str, max_size: int = MAX_SIZE, max_depth: int = MAX_DEPTH) -> Any:
+    """Parse a Python literal of strings, numbers, None, booleans, lists, tuples, sets and dicts like
+    ast.literal_eval, including the adjacent string literals pprint uses to wrap long strings.
+
+    Unlike ast.literal_eval, no syntax tree is built, and input longer than max_size characters or nested deeper
+    than max_depth is rejected with a ValueError."""
+    if len(text) > max_size:
+        raise ValueError('literal exceeds {} characters'.format(max_size))
+    return _Parser(text, max_depth).parse()
+
+
+class _Parser(object):
+
+    def __init__(self, text: str, max_depth: int):
+        self._text = text
+        self._max_depth = max_depth
+        self._position = 0
+
+    def parse(self) -> Any:
+        value = self._value(0)
+        if self._skip_whitespace():
+            self._fail('unexpected data')
+        return value
+
+    def _value(self, depth: int) -> Any:
+        if self._at_string():
+            value = self._string()
+            if not self._at_string():
+                return value
+            parts = [value]
+            while self._at_string():
+                parts.append(self._string())
+            return ''.join(parts)
+
+        c = self._skip_whitespace()
+        if not c:
+            self._fail('unexpected end of data')
+        if c in _CLOSING:
+            if depth >= self._max_depth:
+                self._fail('literal nested deeper than {} levels'.format(self._max_depth))
+            return self._container(c, depth + 1)
+        match = _NUMBER.match(self._text, self._position)
+        if match:
+            self._position = match.end()
+            text = match.group()
+            return float(text) if any(c in text for c in '.eE') else int(text)
+        match = _NAME.match(self._text, self._position)
+        if match and match.group() in _NAMES:
+            self._position = match.end()
+            return _NAMES[match.group()]
+        self._fail('unexpected {!r}'.format(match.group() if match else c))
+
+    def _container(self, opening: str, depth: int) -> Any:
+        if opening == '[':
+            match = _SIMPLE_STRING_LIST.match(self._text, self._position)
+            if match:
+                self._position = match.end()
+                return _SIMPLE_STRING.findall(match.group(1))
+
+        closing = _CLOSING[opening]
+        self._position += 1
+        items = []
+        values = []
+        is_dict = None
+        trailing_comma = False
+        while True:
+            if self._skip_whitespace() == closing:
+                self._position += 1
+                break
+            key = self._value(depth)
+            if is_dict is None:
+                is_dict = opening == '{' and self._skip_whitespace() == ':'
+            if is_dict:
+                self._expect(':')
+                items.append((key, self._value(depth)))
+            else:
+                values.append(key)
+            c = self._skip_whitespace()
+            if c not in (',', closing) or not c:
+                self._fail('expected "," or "{}"'.format(closing))
+            self._position += 1
+            trailing_comma = c == ','
+            if not trailing_comma:
+                break
+
+        try:
+            if opening == '[':
+                return values
+            if opening == '(':
+                return values[0] if len(values) == 1 and not trailing_comma else tuple(values)
+            if is_dict or not values:
+                return dict(items)
+            return set(values)
+        except TypeError as e:
+            raise ValueError(str(e)) from None
+
+    def _at_string(self) -> bool:
+        c = self._skip_whitespace()
+        if c and c in 'uU':
+            c = self._text[self._position + 1:self._position + 2]
+        return bool(c) and c in '\'"'
+
+    def _string(self) -> str:
+        if self._text[self._position] in 'uU':
+            self._position += 1
+        match = _STRINGS[self._text[self._position]].match(self._text, self._position)
+        if not match:
+            self._fail('unterminated string')
+        self._position = match.end()
+        body = match.group(1)
+        return _ESCAPE.sub(_unescape, body) if '\\' in body else body
+
+    def _expect(self, punctuation: str) -> None:
+        if self._skip_whitespace() != punctuation:
+            self._fail('expected "{}"'.format(punctuation))
+        self._position += 1
+
+    def _skip_whitespace(self) -> str:
+        """Move to the next non-whitespace character and return it, or an empty string at the end of the text."""
+        self._position = _WHITESPACE.match(self._text, self._position).end()
+        return self._text[self._position:self._position + 1]
+
+    def _fail(self, message: str):
+        raise ValueError('{} at position {}'.format(message, self._position))
+
+
+def _unescape(match) -> str:
+    escape = match.group()[1:]
+    if escape[0] == 'N':
+        try:
+            return unicodedata.lookup(escape[2:-1])
+        except KeyError:
+            raise ValueError('malformed \\N character escape') from None
+    if escape[0] in 'xuU':
+        if len(escape) == 1:
+            raise ValueError('truncated \\{} escape'.format(escape))
+        return chr(int(escape[1:], 16))
+    if escape[0] in '01234567':
+        return chr(int(escape, 8))
+    return _SIMPLE_ESCAPES.get(escape, match.group())
@@ -0,0 +1,174 @@
+import array
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+
+class FileMetadata(NamedTuple):
+    size: int
+    mode: int
+    hash: Optional[str]
+
+
+def _encode(relpath: str) -> bytes:
+    return relpath.encode('utf-8', 'surrogateescape')
+
+
+class _DirectoryManifest(object):
+    """The files of one top-level directory.
+
+    All relative paths are stored UTF-8 encoded in a single buffer, with their end offsets and hashes in arrays. An
+    open-addressing hash table of positions in another array finds a path in constant time. The size and mode of the
+    files are kept in arrays as well, and their hashes in a list, each created when the first file needing it is
+    added."""
+    __slots__ = ('names', 'ends', 'name_hashes', 'table', 'sizes', 'modes', 'hashes')
+
+    def __init__(self):
+        self.names = bytearray()
+        self.ends = array.array('I')
+        self.name_hashes = array.array('q')
+        # position + 1 of the file in every slot, 0 for an empty slot; always at most half full
+        self.table = array.array('I', bytes(4 * 8))
+        self.sizes: Optional[array.array] = None
+        self.modes: Optional[array.array] = None
+        self.hashes: Optional[List[Optional[str]]] = None
+
+    def _name(self, position: int) -> bytes:
+        start = self.ends[position - 1] if position else 0
+        return self.names[start:self.ends[position]]
+
+    def _slot(self, name_hash: int, encoded: bytes) -> int:
+        """Return the slot of the table holding the path, or the empty slot where it belongs."""
+        table, mask = self.table, len(self.table) - 1
+        slot = name_hash & mask
+        while True:
+            entry = table[slot]
+            if not entry or (self.name_hashes[entry - 1] == name_hash and self._name(entry - 1) == encoded):
+                return slot
+            slot = (slot + 1) & mask
+
+    def find(self, relpath: str) -> Optional[int]:
+        """Return the position of a file, or None if it is not listed."""
+        entry = self.table[self._slot(hash(relpath), _encode(relpath))]
+        return entry - 1 if entry else None
+
+    def add(self, relpath: str, size: int, mode: int, hash_: Optional[str]) -> None:
+        name_hash, encoded = hash(relpath), _encode(relpath)
+        slot = self._slot(name_hash, encoded)
+        if self.table[slot]:
+            return
+        position = len(self.ends)
+        self.names += encoded
+        self.ends.append(len(self.names))
+        self.name_hashes.append(name_hash)
+        self.table[slot] = position + 1
+        if 2 * (position + 1) > len(self.table):
+            self._grow()
+        if (size != -1 or mode) and self.sizes is None:
+            self.sizes = array.array('q', [-1] * position)
+            self.modes = array.array('I', [0] * position)
+        if self.sizes is not None:
+            self.sizes.append(size)
+            self.modes.append(mode)
+        if hash_ is not None and self.hashes is None:
+            self.hashes = [None] * position
+        if self.hashes is not None:
+            self.hashes.append(hash_)
+
+    def _grow(self) -> None:
+        table = array.array('I', bytes(8 * len(self.table)))
+        mask = len(table) - 1
+        for position, name_hash in enumerate(self.name_hashes):
+            slot = name_hash & mask
+            while table[slot]:
+                slot = (slot + 1) & mask
+            table[slot] = position + 1
+        self.table = table
+
+    def metadata(self, position: int) -> FileMetadata:
+        hash_ = self.hashes[position] if self.hashes else None
+        if self.sizes is None:
+            return FileMetadata(size=-1, mode=0, hash=hash_)
+        return FileMetadata(size=self.sizes[position], mode=self.modes[position], hash=hash_)
+
+    def relpaths(self) -> Iterator[str]:
+        names, start = self.names, 0
+        for end in self.ends:
+            yield names[start:end].decode('utf-8', 'surrogateescape')
+            start = end
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+
+class Manifest(object):
+    """List of the files of a package, by top-level directory, in the order they were added, with their metadata.
+
+    The paths of the files of a directory are stored in one shared buffer instead of a string object each, and their
+    size, mode and optional hash in arrays, so a manifest takes less memory than the files dict of info. Checking
+    whether a file is listed takes constant time. Every file is listed once; adding it again has no effect."""
+    __slots__ = ('_directories',)
+
+    def __init__(self):
+        self._directories: Dict[str, _DirectoryManifest] = {}
+
+    @classmethod
+    def from_dict(cls, files: Dict[str, Iterable[str]]) -> 'Manifest':
+        """Create a manifest from the files dict of info, without metadata."""
+        manifest = cls()
+        for directory, relpaths in files.items():
+            directory_manifest = manifest._directory(directory)
+            for relpath in relpaths:
+                directory_manifest.add(relpath, -1, 0, None)
+        return manifest
+
+    def to_dict(self) -> Dict[str, List[str]]:
+        """Return the files dict of info."""
+        return {directory: list(directory_manifest.relpaths())
+                for directory, directory_manifest in self._directories.items()}
+
+    def add(self, directory: str, relpath: str, size: int = -1, mode: int = 0, hash: Optional[str] = None) -> None:
+        self._directory(directory).add(relpath, size, mode, hash)
+
+    def _directory(self, directory: str) -> _DirectoryManifest:
+        directory_manifest = self._directories.get(directory)
+        if directory_manifest is None:
+            directory_manifest = self._directories[directory] = _DirectoryManifest()
+        return directory_manifest
+
+    def directories(self) -> List[str]:
+        return list(self._directories)
+
+    def files(self, directory: str) -> Iterator[str]:
+        """Iterate over the relative paths of the files in directory."""
+        directory_manifest = self._directories.get(directory)
+        return directory_manifest.relpaths() if directory_manifest else iter(())
+
+    def contains(self, directory: str, relpath: str) -> bool:
+        directory_manifest = self._directories.get(directory)
+        return directory_manifest is not None and directory_manifest.find(relpath) is not None
+
+    def metadata(self, directory: str, relpath: str) -> FileMetadata:
+        """Return the metadata of a file. A size of -1 means the size is unknown."""
+        directory_manifest = self._directories.get(directory)
+        position = directory_manifest.find(relpath) if directory_manifest else None
+        if position is None:
+            raise KeyError((directory, relpath))
+        return directory_manifest.metadata(position)
+
+    def __contains__(self, item: Tuple[str, str]) -> bool:
+        return self.contains(*item)
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        for directory in self._directories:
+            for relpath in self.files(directory):
+                yield directory, relpath
+
+    def __len__(self) -> int:
+        return sum(len(directory_manifest) for directory_manifest in self._directories.values())
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Manifest):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return 'Manifest.from_dict({!r})'.format(self.to_dict())
@@ -0,0 +1,66 @@
+import io
+import mmap
+from typing import BinaryIO, Optional
+
+
+class MemoryReader(io.RawIOBase):
+    """Seekable read-only file object over a buffer, e.g. a bytearray, memoryview or mmap, without copying it."""
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._buffer_view = memoryview(buffer)
+        self._view = self._buffer_view if self._buffer_view.format == 'B' else self._buffer_view.cast('B')
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._view[self._position:self._position + len(buffer)]
+        length = len(data)
+        memoryview(buffer).cast('B')[:length] = data
+        self._position += length
+        return length
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        if self.closed:
+            raise ValueError('read from closed file')
+        end = len(self._view) if size is None or size < 0 else self._position + size
+        data = self._view[self._position:end].tobytes()
+        self._position += len(data)
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence ({})'.format(whence))
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        if not self.closed:
+            self._view.release()
+            self._buffer_view.release()
+        super().close()
+
+
+def map_file(file: BinaryIO) -> Optional[mmap.mmap]:
+    """Map a file read-only into memory. Returns None for files that cannot be mapped, e.g. empty ones."""
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return None
@@ -0,0 +1,135 @@
+import io
+import queue
+import threading
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar('T')
+
+_PUT_TIMEOUT = 0.1
+_CHUNK_SIZE = 256 * 1024
+
+
+class BackgroundIterator(Iterator[T]):
+    """Run an iterator in its own thread and hand over its items through a queue of at most maxsize items.
+
+    On close, the iterator is closed, and items it produced that were not consumed are passed to discard."""
+
+    _END = object()
+
+    def __init__(self, iterable: Iterable[T], maxsize: int, discard: Optional[Callable[[T], None]] = None):
+        self._queue = queue.Queue(maxsize)
+        self._discard = discard
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iterable,), daemon=True)
+        self._thread.start()
+
+    def __next__(self) -> T:
+        is_item, value = self._queue.get()
+        if is_item:
+            return value
+        self._queue.put((False, value))
+        if value is self._END:
+            raise StopIteration
+        raise value
+
+    def __enter__(self) -> 'BackgroundIterator[T]':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        while True:
+            try:
+                is_item, value = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if is_item and self._discard:
+                self._discard(value)
+        self._queue.put((False, self._END))
+
+    def _run(self, iterable: Iterable[T]) -> None:
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not self._put((True, item)):
+                    if self._discard:
+                        self._discard(item)
+                    return
+        except BaseException as e:
+            self._put((False, e))
+        else:
+            self._put((False, self._END))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def _put(self, item) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+class ThreadedWriter(io.RawIOBase):
+    """Write-only file object that collects writes into chunks and writes them to target in its own thread.
+
+    At most maxsize chunks are queued. An error of the target is raised by the next write or by close."""
+
+    def __init__(self, target: BinaryIO, maxsize: int):
+        super().__init__()
+        self._target = target
+        self._queue = queue.Queue(maxsize)
+        self._buffer = bytearray()
+        self._size = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._size
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError('write to closed file')
+        if self._error:
+            raise self._error
+        self._buffer += data
+        self._size += len(data)
+        if len(self._buffer) >= _CHUNK_SIZE:
+            self._queue.put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._queue.put(bytes(self._buffer))
+                self._buffer.clear()
+            self._queue.put(None)
+            self._thread.join()
+        finally:
+            super().close()
+        if self._error:
+            raise self._error
+
+    def _run(self) -> None:
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            if self._error is None:
+                try:
+                    self._target.write(data)
+                except BaseException as e:
+                    self._error = e
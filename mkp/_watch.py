@@ -0,0 +1,220 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+               | _IN_DELETE_SELF | _IN_MOVE_SELF)
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+def wait_for_changes(path: str, directories: Optional[List[str]], excluded: Set[str], debounce: float,
+                     poll_interval: float, use_inotify: bool = True) -> Iterator[Set[str]]:
+    """Yield the set of changed top-level directories after every burst of changes below path.
+
+    Only the given directories are watched, or all non-hidden subdirectories except the excluded ones if directories
+    is None. A burst ends when no further change arrived for debounce seconds. inotify is used on Linux, other
+    platforms fall back to polling every poll_interval seconds. So does Linux if inotify fails, e.g. because the
+    limit of inotify watches is reached; if that happens while watching, all directories are reported as changed.
+    """
+    watcher = _InotifyWatcher.create(path, directories, excluded) if use_inotify else None
+    if watcher is None:
+        watcher = _PollingWatcher(path, directories, excluded, poll_interval)
+    try:
+        while True:
+            try:
+                changed = watcher.wait(None)
+                while True:
+                    more = watcher.wait(debounce)
+                    if not more:
+                        break
+                    changed |= more
+            except OSError:
+                if not isinstance(watcher, _InotifyWatcher):
+                    raise
+                # changes may have been missed while the watches were incomplete
+                watcher.close()
+                watcher = _PollingWatcher(path, directories, excluded, poll_interval)
+                changed = watcher.directories()
+            yield changed
+    finally:
+        watcher.close()
+
+
+def _is_watched_name(name: str) -> bool:
+    return not name.startswith('.') and not name.endswith('~')
+
+
+def _is_watched_directory(name: str, directories: Optional[List[str]], excluded: Set[str]) -> bool:
+    if directories is None:
+        return _is_watched_name(name) and name not in excluded
+    return name in directories
+
+
+class _PollingWatcher(object):
+
+    def __init__(self, path: str, directories: Optional[List[str]], excluded: Set[str], interval: float):
+        self._path = path
+        self._directories = directories
+        self._excluded = excluded
+        self._interval = interval
+        self._snapshot = self._take_snapshot()
+
+    def wait(self, timeout: Optional[float]) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = self._interval if deadline is None else min(self._interval, deadline - time.monotonic())
+            if remaining > 0:
+                time.sleep(remaining)
+            snapshot = self._take_snapshot()
+            changed = {key[0] for key in snapshot.keys() ^ self._snapshot.keys()}
+            changed |= {key[0] for key, value in snapshot.items() if self._snapshot.get(key, value) != value}
+            self._snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self) -> None:
+        pass
+
+    def directories(self) -> Set[str]:
+        return {directory for directory, _ in self._snapshot}
+
+    def _take_snapshot(self) -> Dict[Tuple[str, str], Tuple[int, int, int]]:
+        snapshot = {}
+        try:
+            names = os.listdir(self._path)
+        except FileNotFoundError:
+            return snapshot
+        for name in names:
+            if _is_watched_directory(name, self._directories, self._excluded):
+                self._scan(name, os.path.join(self._path, name), '', snapshot)
+        return snapshot
+
+    def _scan(self, directory: str, path: str, prefix: str, snapshot: Dict) -> None:
+        try:
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for entry in entries:
+            if not _is_watched_name(entry.name):
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            snapshot[(directory, prefix + entry.name)] = (st.st_mtime_ns, st.st_size, st.st_mode)
+            if entry.is_dir(follow_symlinks=False):
+                self._scan(directory, entry.path, prefix + entry.name + '/', snapshot)
+
+
+class _InotifyWatcher(object):
+
+    def __init__(self, libc, fd: int, path: str, directories: Optional[List[str]], excluded: Set[str]):
+        self._libc = libc
+        self._fd = fd
+        self._path = path
+        self._directories = directories
+        self._excluded = excluded
+        self._watches = {}
+        self._add_watch(path, None)
+        for name in os.listdir(path):
+            if _is_watched_directory(name, directories, excluded):
+                self._add_tree(os.path.join(path, name), name)
+
+    @classmethod
+    def create(cls, path: str, directories: Optional[List[str]], excluded: Set[str]) -> Optional['_InotifyWatcher']:
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            return None
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            return None
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        try:
+            return cls(libc, fd, path, directories, excluded)
+        except OSError:
+            os.close(fd)
+            return None
+        except BaseException:
+            os.close(fd)
+            raise
+
+    def wait(self, timeout: Optional[float]) -> Set[str]:
+        changed = set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not changed:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if not readable:
+                break
+            changed |= self._read_events()
+        return changed
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def _add_watch(self, path: str, directory: Optional[str]) -> int:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        self._watches[wd] = (path, directory)
+        return wd
+
+    def _add_tree(self, path: str, directory: str) -> None:
+        try:
+            self._add_watch(path, directory)
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for entry in entries:
+            if _is_watched_name(entry.name) and entry.is_dir(follow_symlinks=False):
+                self._add_tree(entry.path, directory)
+
+    def _read_events(self) -> Set[str]:
+        changed = set()
+        data = os.read(self._fd, _READ_SIZE)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                changed.update(directory for _, directory in self._watches.values() if directory is not None)
+                continue
+            if mask & _IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches:
+                continue
+            path, directory = self._watches[wd]
+            if directory is None:
+                if not _is_watched_directory(name, self._directories, self._excluded):
+                    continue
+                directory = name
+                if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._add_tree(os.path.join(path, name), name)
+            elif name and not _is_watched_name(name):
+                continue
+            elif mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                self._add_tree(os.path.join(path, name), directory)
+            changed.add(directory)
+        return changed
@@ -1,15 +1,15 @@
 import argparse
 import os
-from mkp import load_file
+from mkp import encode_info, load_file
 
 
 def main():
     args = _parse_args()
-    package = load_file(args.mkp_file)
-    extract_path = _get_extract_path(args.output_dir, args.no_prefix, package)
-    os.makedirs(extract_path, exist_ok=True)
-    package.extract_files(extract_path)
-    _write_info_files(package, extract_path)
+    with load_file(args.mkp_file) as package:
+        extract_path = _get_extract_path(args.output_dir, args.no_prefix, package)
+        os.makedirs(extract_path, exist_ok=True)
+        package.extract_files(extract_path)
+        _write_info_files(package, extract_path)
 
 
 def _parse_args():
@@ -36,9 +36,8 @@ def _get_extract_path(output_dir, no_prefix, package):
 def _write_info_files(package, extract_path):
     info_path = os.path.join(extract_path, "info")
     info_json_path = os.path.join(extract_path, "info.json")
-    with open(info_path, "w") as f:
-        import pprint
-        f.write(pprint.pformat(package.info))
+    with open(info_path, "wb") as f:
+        f.write(encode_info(package.info))
     if package.json_info is not None:
         import json
         with open(info_json_path, "w") as f:
@@ -0,0 +1,26 @@
+import argparse
+import logging
+import os
+import runpy
+
+
+def main():
+    args = _parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    os.environ['MKP_WATCH'] = '1'
+    try:
+        runpy.run_path(args.dist_script, run_name='__main__')
+    except KeyboardInterrupt:
+        pass
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Run a dist.py script in watch mode: build the package, then '
+                                                 'rebuild it whenever files in the package directories change.')
+    parser.add_argument('dist_script', nargs='?', default='dist.py',
+                        help='Path to the dist.py script (default: dist.py)')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -37,6 +37,7 @@ setup(
         'console_scripts': [
             'mkp-extract=mkp.cli.extract:main',
             'mkp-init=mkp.cli.init:main',
+            'mkp-watch=mkp.cli.watch:main',
         ],
     },
 )
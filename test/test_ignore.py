@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+from mkp._ignore import IgnoreRules
+
+
+@pytest.mark.parametrize('rules, path, is_dir, expected', [
+    (['*.pyc'], 'agents/foo.pyc', False, True),
+    (['*.pyc'], 'agents/foo.py', False, False),
+    (['build'], 'agents/sub/build', True, True),
+    (['build'], 'agents/sub/build/file', False, True),
+    (['/build'], 'agents/build', True, False),
+    (['/agents/build'], 'agents/build', True, True),
+    (['agents/*.py'], 'agents/foo.py', False, True),
+    (['agents/*.py'], 'agents/sub/foo.py', False, False),
+    (['agents/**/foo.py'], 'agents/foo.py', False, True),
+    (['agents/**/foo.py'], 'agents/a/b/foo.py', False, True),
+    (['**/generated'], 'web/htdocs/generated', True, True),
+    (['agents/**'], 'agents', True, False),
+    (['agents/**'], 'agents/sub/file', False, True),
+    (['tmp/'], 'agents/tmp', False, False),
+    (['tmp/'], 'agents/tmp', True, True),
+    (['*.log', '!keep.log'], 'agents/keep.log', False, False),
+    (['*.log', '!keep.log'], 'agents/drop.log', False, True),
+    (['!keep.log', '*.log'], 'agents/keep.log', False, True),
+    (['out/', '!out/keep'], 'agents/out/keep', False, True),
+    (['file[0-9].txt'], 'agents/file7.txt', False, True),
+    (['file[!0-9].txt'], 'agents/file7.txt', False, False),
+    (['file?.txt'], 'agents/fileX.txt', False, True),
+    (['\\#notes', '# comment', ''], 'agents/#notes', False, True),
+    (['\\!important'], 'agents/!important', False, True),
+    (['trailing   '], 'agents/trailing', False, True),
+    (['*'], 'agents', True, True),
+    (['*\\*'], 'agents/foo*', False, True),
+    (['*\\*'], 'agents/foo', False, False),
+    (['*.py', 'f*', '!fo?.py'], 'agents/foo.py', False, False),
+    (['!fo?.py', 'f*', '*.py'], 'agents/foo.py', False, True),
+    (['f*.txt', '*o.txt', 'b?r'], 'agents/foo.txt', False, True),
+    (['f*.txt', '*o.txt', 'b?r'], 'agents/bar', False, True),
+    (['f*.txt', '*o.txt', 'b?r'], 'agents/baz', False, False),
+])
+def test_ignore_rules_match_like_gitignore(rules, path, is_dir, expected):
+    assert IgnoreRules(rules).match(path, is_dir=is_dir) == expected
+
+
+def test_ignore_rules_match_time_does_not_grow_with_the_number_of_globs():
+    # given
+    paths = ['agents/sub{}/file{}.py'.format(i % 50, i) for i in range(5000)]
+
+    def measure(num_rules):
+        rules = IgnoreRules(['*.ext{}'.format(i) for i in range(num_rules)] + ['/web/*.py', 'data?'])
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            for path in paths:
+                rules.match(path)
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        return best
+
+    # when
+    few, many = measure(10), measure(1000)
+
+    # then
+    assert many < 3 * few
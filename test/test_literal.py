@@ -0,0 +1,94 @@
+import ast
+import pprint
+
+import pytest
+
+from mkp._literal import parse_literal
+
+
+@pytest.mark.parametrize('text', [
+    "{'name': 'foo', 'version': '1.0', 'version.usable_until': None, 'num_files': 3}",
+    "{'files': {'checks': ['foo', 'bar'], 'agents': []}, 'enabled': True, 'disabled': False}",
+    "[1, -2, 3.5, -0.25, 1e3, 2E-2, .5, 7.]",
+    "(1, 2)",
+    "(1,)",
+    "()",
+    "(('nested',),)",
+    "{}",
+    "{1, 2, 3}",
+    "[1, 2, ]",
+    "{'a': 1,}",
+    "('wrapped '\n 'string')",
+    "'adjacent' \"strings\"",
+    "['adjacent' 'in list', 'x']",
+    "['plain', 'with \\'quote\\'', \"it's\"]",
+    "['a',\n 'b',\n 'c',\n]",
+    "u'unicode prefix'",
+    r"'escapes: \\ \' \" \n \t \r \a \b \f \v \x41 é \U0001F600 \101 \0'",
+    "'line \\\ncontinuation'",
+    '"\'single\' in double"',
+    "'café ☃'",
+    r"'\N{BULLET} \N{LATIN SMALL LETTER E WITH ACUTE}'",
+    "{'whitespace' :\t[\n 1 ] }  \n",
+])
+def test_parse_literal_matches_literal_eval(text):
+    assert parse_literal(text) == ast.literal_eval(text)
+
+
+def test_parse_literal_decodes_pprint_output_of_large_info():
+    # given
+    info = {
+        'name': 'foo',
+        'title': 'A title that is long enough to be wrapped by pprint into several adjacent string literals ' * 3,
+        'description': 'Multi-line\ndescription with \'quotes\' and "double quotes" and unicode: äöü',
+        'files': {'mibs': ['MIB-{:05}.txt'.format(i) for i in range(2000)], 'checks': []},
+        'version.usable_until': None,
+        'num_files': 2000,
+    }
+    text = pprint.pformat(info)
+
+    # when
+    parsed = parse_literal(text)
+
+    # then
+    assert parsed == info
+    assert parsed == ast.literal_eval(text)
+
+
+@pytest.mark.parametrize('text', [
+    "",
+    "{'a': 1",
+    "[1 2]",
+    "{'a': 1, 2}",
+    "{1, 'a': 2}",
+    "{[1]: 2}",
+    "{[1], [2]}",
+    "__import__('os')",
+    "foo",
+    "1 + 2",
+    "'unterminated",
+    "'new\nline'",
+    "b'bytes'",
+    "[1], [2]",
+    "'\\x4'",
+    r"'\N{NO SUCH CHARACTER}'",
+    r"'\N'",
+    r"'\Nfoo'",
+    "{'a': 1}}",
+])
+def test_parse_literal_rejects_invalid_input(text):
+    with pytest.raises(ValueError):
+        parse_literal(text)
+
+
+def test_parse_literal_rejects_input_exceeding_the_size_limit():
+    with pytest.raises(ValueError, match='exceeds'):
+        parse_literal("'" + 'x' * 100 + "'", max_size=50)
+
+
+def test_parse_literal_rejects_input_exceeding_the_depth_limit():
+    assert parse_literal('[' * 10 + ']' * 10, max_depth=10) == ast.literal_eval('[' * 10 + ']' * 10)
+    with pytest.raises(ValueError, match='nested deeper'):
+        parse_literal('[' * 11 + ']' * 11, max_depth=10)
+    with pytest.raises(ValueError, match='nested deeper'):
+        parse_literal('[' * 100000 + ']' * 100000)
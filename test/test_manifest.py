@@ -0,0 +1,133 @@
+import os
+import stat
+import tracemalloc
+
+import pytest
+
+import mkp
+from mkp import FileMetadata, Manifest
+
+FILES = {
+    'agents': ['special/agent_foo', 'plugins/foo', 'special/agent_bar', 'top'],
+    'checks': ['foo'],
+    'web': [],
+}
+
+
+def test_manifest_round_trips_the_files_dict():
+    # when
+    manifest = Manifest.from_dict(FILES)
+
+    # then
+    assert manifest.to_dict() == FILES
+    assert manifest.directories() == ['agents', 'checks', 'web']
+    assert list(manifest.files('agents')) == FILES['agents']
+    assert list(manifest) == [(directory, relpath) for directory, files in FILES.items() for relpath in files]
+    assert len(manifest) == 5
+    assert manifest == Manifest.from_dict(FILES)
+
+
+@pytest.mark.parametrize('directory, relpath, expected', [
+    ('agents', 'special/agent_bar', True),
+    ('agents', 'plugins/foo', True),
+    ('agents', 'top', True),
+    ('agents', 'foo', False),
+    ('agents', 'special', False),
+    ('agents', 'special/agent_foo/x', False),
+    ('agents', 'other/top', False),
+    ('checks', 'foo', True),
+    ('web', 'foo', False),
+    ('doc', 'foo', False),
+])
+def test_manifest_contains(directory, relpath, expected):
+    # given
+    manifest = Manifest.from_dict(FILES)
+
+    # when / then
+    assert manifest.contains(directory, relpath) is expected
+    assert ((directory, relpath) in manifest) is expected
+
+
+def test_manifest_stores_metadata():
+    # given
+    manifest = Manifest()
+
+    # when
+    manifest.add('agents', 'plain')
+    manifest.add('agents', 'sub/sized', size=42, mode=0o100644)
+    manifest.add('agents', 'sub/hashed', size=7, mode=0o100755, hash='abc')
+    manifest.add('agents', 'sub/sized', size=1)
+
+    # then
+    assert manifest.metadata('agents', 'plain') == FileMetadata(size=-1, mode=0, hash=None)
+    assert manifest.metadata('agents', 'sub/sized') == FileMetadata(size=42, mode=0o100644, hash=None)
+    assert manifest.metadata('agents', 'sub/hashed') == FileMetadata(size=7, mode=0o100755, hash='abc')
+    assert manifest.to_dict() == {'agents': ['plain', 'sub/sized', 'sub/hashed']}
+    with pytest.raises(KeyError):
+        manifest.metadata('agents', 'missing')
+
+
+def test_find_manifest_matches_find_files(tmpdir):
+    # given
+    tmpdir.join('agents', 'special', 'agent_test').write_binary(b'hello', ensure=True)
+    tmpdir.join('checks', 'foo').write_binary(b'Check Me!', ensure=True)
+
+    # when
+    manifest = mkp.find_manifest(str(tmpdir))
+
+    # then
+    assert manifest.to_dict() == mkp.find_files(str(tmpdir))
+    metadata = manifest.metadata('checks', 'foo')
+    assert metadata.size == 9
+    assert metadata.mode == os.lstat(str(tmpdir.join('checks', 'foo'))).st_mode
+    assert stat.S_ISREG(metadata.mode)
+
+
+def test_pack_and_extract_with_manifest(tmpdir):
+    # given
+    tmpdir.join('src', 'checks', 'foo').write_binary(b'Check Me!', ensure=True)
+    tmpdir.join('src', 'checks', 'sub', 'bar').write_binary(b'Bar', ensure=True)
+    info = {'name': 'foo', 'files': mkp.find_manifest(str(tmpdir.join('src')))}
+
+    # when
+    package = mkp.load_bytes(mkp.pack_to_bytes(info, str(tmpdir.join('src'))))
+    package.extract_files(str(tmpdir.join('dest')))
+
+    # then
+    assert package.info['files'] == {'checks': ['foo', 'sub/bar']}
+    assert package.manifest.contains('checks', 'sub/bar')
+    assert tmpdir.join('dest', 'checks', 'sub', 'bar').read_binary() == b'Bar'
+
+
+def test_manifest_finds_every_file_after_growing():
+    # given
+    relpaths = ['vendor{}/sub/MIB-{:06d}.txt'.format(i % 7, i) for i in range(5000)] + ['ünïcode', 'bad\udcff']
+
+    # when
+    manifest = Manifest.from_dict({'agents': relpaths})
+
+    # then
+    assert all(manifest.contains('agents', relpath) for relpath in relpaths)
+    assert not manifest.contains('agents', 'vendor0/sub/MIB-000001.txt')
+    assert list(manifest.files('agents')) == relpaths
+
+
+def test_manifest_takes_less_memory_than_the_files_dict():
+    # given
+    relpaths = ['vendor{}/sub/MIB-{:06d}.txt'.format(i % 50, i) for i in range(20000)]
+
+    # when
+    tracemalloc.start()
+    try:
+        files = {'agents': [relpath.encode().decode() for relpath in relpaths]}
+        dict_size = tracemalloc.get_traced_memory()[0]
+        del files
+        before = tracemalloc.get_traced_memory()[0]
+        manifest = Manifest.from_dict({'agents': relpaths})
+        manifest_size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    # then
+    assert len(manifest) == len(relpaths)
+    assert manifest_size < 0.75 * dict_size
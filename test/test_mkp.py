@@ -1,7 +1,12 @@
 import ast
+import errno
+import gzip
 import io
+import multiprocessing
+import os
 import re
 import tarfile
+import threading
 
 import pytest
 
@@ -381,3 +386,1057 @@ dist({
     assert package.info['version'] == '42'
     assert package.info['version.packaged'] == 'python-mkp'
     assert package.info['num_files'] == 2
+
+
+def test_pack_to_file_spools_large_directory_archives_to_disk(tmpdir, monkeypatch):
+    # given
+    monkeypatch.setattr(mkp, '_SPOOL_MAX_SIZE', 1024)
+    payload = bytes(range(256)) * 64
+    info = {
+        'files': {'agents': ['big_agent'], 'checks': ['foo']},
+    }
+    tmpdir.join('agents', 'big_agent').write_binary(payload, ensure=True)
+    tmpdir.join('checks', 'foo').write_binary(b'Check Me!', ensure=True)
+    outfile = tmpdir.join('test.mkp')
+
+    # when
+    mkp.pack_to_file(info, str(tmpdir), str(outfile))
+
+    # then
+    archive = tarfile.open(str(outfile))
+    agents_archive = tarfile.open(fileobj=archive.extractfile('agents.tar'), mode='r:')
+    assert agents_archive.extractfile('big_agent').read() == payload
+    checks_archive = tarfile.open(fileobj=archive.extractfile('checks.tar'), mode='r:')
+    assert checks_archive.extractfile('foo').read() == b'Check Me!'
+
+
+class NonSeekableWriter(io.RawIOBase):
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+
+def test_pack_to_stream_writes_to_non_seekable_stream(tmpdir):
+    # given
+    info = {
+        'files': {'agents': ['special/agent_test']},
+        'title': 'Test package',
+    }
+    tmpdir.join('agents', 'special', 'agent_test').write_binary(b'hello', ensure=True)
+    stream = NonSeekableWriter()
+
+    # when
+    mkp.pack_to_stream(info, str(tmpdir), stream)
+
+    # then
+    package = mkp.load_bytes(stream.getvalue())
+    assert package.info['title'] == 'Test package'
+    assert package.info['files'] == {'agents': ['special/agent_test']}
+    dest = tmpdir.join('dest').mkdir()
+    package.extract_files(str(dest))
+    assert dest.join('agents', 'special', 'agent_test').read_binary() == b'hello'
+
+
+@pytest.mark.parametrize('jobs', [1, 2, 4])
+def test_pack_to_bytes_with_parallel_compression(tmpdir, jobs):
+    # given
+    payload = b''.join(str(i).encode() * 7 for i in range(50000))
+    info = {
+        'files': {'agents': ['big_agent'], 'checks': ['foo']},
+    }
+    tmpdir.join('agents', 'big_agent').write_binary(payload, ensure=True)
+    tmpdir.join('checks', 'foo').write_binary(b'Check Me!', ensure=True)
+
+    # when
+    data = mkp.pack_to_bytes(info, str(tmpdir), jobs=jobs)
+
+    # then
+    archive = tarfile.open(fileobj=io.BytesIO(data), mode='r:gz')
+    agents_archive = tarfile.open(fileobj=archive.extractfile('agents.tar'), mode='r:')
+    assert agents_archive.extractfile('big_agent').read() == payload
+    checks_archive = tarfile.open(fileobj=archive.extractfile('checks.tar'), mode='r:')
+    assert checks_archive.extractfile('foo').read() == b'Check Me!'
+
+
+def test_dist_with_parallel_compression(tmpdir, sample_files, sample_info):
+    mkp.dist(sample_info, str(tmpdir), jobs=2)
+
+    package = mkp.load_file(str(tmpdir.join('dist', 'foo-42.mkp')))
+    assert package.info['files']['agents'] == ['special/agent_test']
+    assert package.info['files']['checks'] == ['foo']
+
+
+def test_pack_to_bytes_builds_directory_archives_concurrently_in_original_order(tmpdir):
+    # given
+    info = {
+        'files': {directory: ['test_{}'.format(i) for i in range(20)] for directory in DIRECTORIES},
+    }
+    for directory in DIRECTORIES:
+        for i in range(20):
+            tmpdir.join(directory, 'test_{}'.format(i)).write_binary(directory.encode() * i, ensure=True)
+
+    # when
+    sequential = mkp.pack_to_bytes(dict(info), str(tmpdir), jobs=1)
+    concurrent = mkp.pack_to_bytes(dict(info), str(tmpdir), jobs=4)
+
+    # then
+    assert gzip.decompress(concurrent) == gzip.decompress(sequential)
+    names = tarfile.open(fileobj=io.BytesIO(concurrent)).getnames()
+    assert names == ['info', 'info.json'] + [directory + '.tar' for directory in DIRECTORIES]
+
+
+def test_pack_to_bytes_reuses_cached_directory_archives(tmpdir):
+    # given
+    info = {
+        'files': {'agents': ['special/agent_test'], 'checks': ['foo']},
+    }
+    source = tmpdir.join('source')
+    source.join('agents', 'special', 'agent_test').write_binary(b'hello', ensure=True)
+    source.join('checks', 'foo').write_binary(b'Check Me!', ensure=True)
+    first_cache = mkp.BuildCache(str(tmpdir.join('cache')))
+    second_cache = mkp.BuildCache(str(tmpdir.join('cache')))
+
+    # when
+    mkp.pack_to_bytes(dict(info), str(source), cache=first_cache)
+    source.join('checks', 'foo').write_binary(b'Check Me again!')
+    second = mkp.pack_to_bytes(dict(info), str(source), cache=second_cache)
+
+    # then
+    assert (first_cache.hits, first_cache.misses) == (0, 2)
+    assert (second_cache.hits, second_cache.misses) == (1, 1)
+    archive = tarfile.open(fileobj=io.BytesIO(second))
+    checks_archive = tarfile.open(fileobj=archive.extractfile('checks.tar'), mode='r:')
+    assert checks_archive.extractfile('foo').read() == b'Check Me again!'
+
+
+@pytest.mark.parametrize('cache, expected', [(True, b'Check Me!'), (mkp.CACHE_HASH_CONTENTS, b'Check Us!')])
+def test_dist_with_cache_detects_content_changes_only_when_hashing(tmpdir, sample_files, sample_info, cache,
+                                                                     expected):
+    # given
+    mkp.dist(dict(sample_info), str(tmpdir), cache=cache)
+    st = os.stat(str(tmpdir.join('checks', 'foo')))
+    tmpdir.join('checks', 'foo').write_binary(b'Check Us!')
+    os.utime(str(tmpdir.join('checks', 'foo')), ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    # when
+    mkp.dist(dict(sample_info), str(tmpdir), cache=cache)
+
+    # then
+    package = mkp.load_file(str(tmpdir.join('dist', 'foo-42.mkp')))
+    assert package.read('checks', 'foo') == expected
+
+
+def test_dist_with_cache_removes_stale_entries(tmpdir, sample_files, sample_info):
+    # given
+    mkp.dist(dict(sample_info), str(tmpdir), cache=True)
+    tmpdir.join('checks', 'foo').write_binary(b'Changed')
+
+    # when
+    mkp.dist(dict(sample_info), str(tmpdir), cache=True)
+
+    # then
+    assert len(tmpdir.join('dist', '.cache', 'foo').listdir()) == 2
+    package = mkp.load_file(str(tmpdir.join('dist', 'foo-42.mkp')))
+    dest = tmpdir.join('dest').mkdir()
+    package.extract_files(str(dest))
+    assert dest.join('checks', 'foo').read_binary() == b'Changed'
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_pack_to_bytes_in_reproducible_mode_is_byte_identical(tmpdir, jobs):
+    # given
+    first = tmpdir.join('first')
+    second = tmpdir.join('second')
+    for source, mtime in [(first, 1000000000), (second, 1600000000)]:
+        source.join('checks', 'foo').write_binary(b'Check Me!', ensure=True)
+        source.join('checks', 'bar').write_binary(b'Check Me too!', ensure=True)
+        source.join('agents', 'special', 'agent_test').write_binary(b'hello', ensure=True)
+        for path in source.visit():
+            path.setmtime(mtime)
+
+    # when
+    first_data = mkp.pack_to_bytes({'files': {'checks': ['foo', 'bar'], 'agents': ['special/agent_test']}},
+                                   str(first), jobs=jobs, reproducible=True)
+    second_data = mkp.pack_to_bytes({'files': {'agents': ['special/agent_test'], 'checks': ['bar', 'foo']}},
+                                    str(second), jobs=jobs, reproducible=True)
+
+    # then
+    assert first_data == second_data
+    archive = tarfile.open(fileobj=io.BytesIO(first_data))
+    assert archive.getnames() == ['info', 'info.json', 'agents.tar', 'checks.tar']
+    checks_archive = tarfile.open(fileobj=archive.extractfile('checks.tar'), mode='r:')
+    assert checks_archive.getnames() == ['bar', 'foo']
+    assert {(member.mtime, member.uid, member.gid, member.uname) for member in checks_archive} == {(0, 0, 0, '')}
+
+
+def test_pack_to_bytes_in_reproducible_mode_uses_source_date_epoch(tmpdir, monkeypatch):
+    # given
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1234567890')
+    tmpdir.join('checks', 'foo').write_binary(b'Check Me!', ensure=True)
+
+    # when
+    data = mkp.pack_to_bytes({'files': {'checks': ['foo']}}, str(tmpdir), reproducible=True)
+
+    # then
+    assert data[4:8] == (1234567890).to_bytes(4, 'little')
+    archive = tarfile.open(fileobj=io.BytesIO(data))
+    assert {member.mtime for member in archive} == {1234567890}
+    checks_archive = tarfile.open(fileobj=archive.extractfile('checks.tar'), mode='r:')
+    assert checks_archive.getmember('foo').mtime == 1234567890
+
+
+def test_dist_with_skip_unchanged_does_not_rebuild_unchanged_package(tmpdir, sample_files, sample_info, monkeypatch):
+    # given
+    mkp.dist(dict(sample_info), str(tmpdir), skip_unchanged=True)
+    packed = []
+    monkeypatch.setattr(mkp, '_pack', lambda *args, **kwargs: packed.append(args))
+
+    # when
+    mkp.dist(dict(sample_info), str(tmpdir), skip_unchanged=True)
+
+    # then
+    assert packed == []
+    assert tmpdir.join('dist', 'foo-42.mkp').exists()
+
+
+@pytest.mark.parametrize('change', [
+    lambda tmpdir, info: tmpdir.join('checks', 'foo').write_binary(b'Changed size'),
+    lambda tmpdir, info: tmpdir.join('checks', 'bar').write_binary(b'New file'),
+    lambda tmpdir, info: tmpdir.join('checks', 'foo').setmtime(1000000000),
+    lambda tmpdir, info: info.update(title='New title'),
+    lambda tmpdir, info: tmpdir.join('dist', 'foo-42.mkp').remove(),
+])
+def test_dist_with_skip_unchanged_rebuilds_changed_package(tmpdir, sample_files, sample_info, monkeypatch, change):
+    # given
+    mkp.dist(dict(sample_info), str(tmpdir), skip_unchanged=True)
+    info = dict(sample_info)
+    change(tmpdir, info)
+    packed = []
+    pack = mkp._pack
+    monkeypatch.setattr(mkp, '_pack', lambda *args, **kwargs: packed.append(pack(*args, **kwargs)))
+
+    # when
+    mkp.dist(info, str(tmpdir), skip_unchanged=True)
+
+    # then
+    assert len(packed) == 1
+    package = mkp.load_file(str(tmpdir.join('dist', 'foo-42.mkp')))
+    assert package.info['files'] == mkp.find_files(str(tmpdir))
+
+
+def test_dist_with_skip_unchanged_keeps_previous_package_if_build_fails(tmpdir, sample_files, sample_info,
+                                                                          monkeypatch):
+    # given
+    mkp.dist(dict(sample_info), str(tmpdir), skip_unchanged=True)
+    previous = tmpdir.join('dist', 'foo-42.mkp').read_binary()
+
+    def fail(info, path, fileobj, *args, **kwargs):
+        fileobj.write(b'partial')
+        raise RuntimeError('interrupted')
+
+    monkeypatch.setattr(mkp, '_pack', fail)
+    with pytest.raises(RuntimeError):
+        mkp.dist(dict(sample_info, title='New title'), str(tmpdir), skip_unchanged=True)
+    monkeypatch.undo()
+
+    # when
+    mkp.dist(dict(sample_info), str(tmpdir), skip_unchanged=True)
+
+    # then
+    assert tmpdir.join('dist', 'foo-42.mkp').read_binary() == previous
+    assert sorted(path.basename for path in tmpdir.join('dist').listdir()) == ['.foo-42.mkp.fingerprint', 'foo-42.mkp']
+
+
+def test_dist_with_skip_unchanged_forgets_fingerprint_before_rebuilding(tmpdir, sample_files, sample_info,
+                                                                         monkeypatch):
+    # given
+    mkp.dist(dict(sample_info), str(tmpdir), skip_unchanged=True)
+    fingerprints = []
+    monkeypatch.setattr(mkp, '_pack', lambda *args, **kwargs: fingerprints.append(
+        tmpdir.join('dist', '.foo-42.mkp.fingerprint').exists()))
+
+    # when
+    mkp.dist(dict(sample_info, title='New title'), str(tmpdir), skip_unchanged=True)
+
+    # then
+    assert fingerprints == [False]
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_dist_many_builds_all_packages(tmpdir, sample_files, jobs):
+    # given
+    other = tmpdir.join('other').mkdir()
+    other.join('checks', 'bar').write_binary(b'Check Me too!', ensure=True)
+    specs = [
+        ({'name': 'foo', 'version': '42'}, str(tmpdir)),
+        ({'name': 'foo-agent', 'version': '1.0'}, str(tmpdir)),
+        ({'name': 'bar', 'version': '2.0'}, str(other)),
+    ]
+
+    # when
+    reports = mkp.dist_many(specs, jobs=jobs)
+
+    # then
+    assert [report.name for report in reports] == ['foo', 'foo-agent', 'bar']
+    assert [report.num_files for report in reports] == [2, 2, 1]
+    for report in reports:
+        assert report.size == os.path.getsize(report.outfile)
+        assert report.pack_seconds >= 0 and report.discovery_seconds >= 0
+        assert not report.skipped
+    package = mkp.load_file(str(other.join('dist', 'bar-2.0.mkp')))
+    assert package.info['files'] == {'checks': ['bar']}
+
+
+def test_dist_many_builds_packages_in_spawned_processes(tmpdir, sample_files):
+    # given
+    specs = [
+        ({'name': 'foo', 'version': '42'}, str(tmpdir)),
+        ({'name': 'foo-checks', 'version': '42'}, str(tmpdir)),
+    ]
+
+    # when
+    reports = mkp.dist_many(specs, jobs=2, mp_context=multiprocessing.get_context('spawn'))
+
+    # then
+    assert [report.num_files for report in reports] == [2, 2]
+    assert mkp.load_file(str(tmpdir.join('dist', 'foo-checks-42.mkp'))).read('checks', 'foo') == b'Check Me!'
+
+
+def test_dist_many_walks_shared_directories_once(tmpdir, sample_files, monkeypatch):
+    # given
+    walked = []
+    find_files_in_directory = mkp._find_files_in_directory
+    monkeypatch.setattr(mkp, '_find_files_in_directory',
+                        lambda path, **kwargs: walked.append(path) or find_files_in_directory(path, **kwargs))
+    specs = [
+        ({'name': 'foo', 'version': '42'}, str(tmpdir)),
+        ({'name': 'foo-checks', 'version': '42'}, str(tmpdir)),
+    ]
+
+    # when
+    mkp.dist_many(specs, jobs=1, directories=['agents', 'checks'])
+
+    # then
+    assert sorted(walked) == [str(tmpdir.join('agents')), str(tmpdir.join('checks'))]
+
+
+def test_find_files_does_not_skip_siblings_of_hidden_directories(tmpdir):
+    # given
+    tmpdir.join('agents', '.hidden_a', 'test').write_binary(b'hello', ensure=True)
+    tmpdir.join('agents', '.hidden_b', 'test').write_binary(b'hello', ensure=True)
+    tmpdir.join('agents', 'visible', 'test').write_binary(b'hello', ensure=True)
+
+    # when
+    result = mkp.find_files(str(tmpdir))
+
+    # then
+    assert result == {'agents': ['visible/test']}
+
+
+def test_find_files_lists_files_before_subdirectories_in_sorted_order(tmpdir):
+    # given
+    for name in ['b/y', 'b/x', 'a/z', 'd', 'c']:
+        tmpdir.join('agents', name).write_binary(b'hello', ensure=True)
+
+    # when
+    result = mkp.find_files(str(tmpdir))
+
+    # then
+    assert result == {'agents': ['c', 'd', 'a/z', 'b/x', 'b/y']}
+
+
+def test_find_files_does_not_descend_into_excluded_directories(tmpdir, monkeypatch):
+    # given
+    tmpdir.join('agents', 'plugin.py').write_binary(b'hello', ensure=True)
+    tmpdir.join('agents', '__pycache__', 'plugin.cpython-38.pyc').write_binary(b'hello', ensure=True)
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scanned.append(path) or scandir(path))
+
+    # when
+    result = mkp.find_files(str(tmpdir), exclude_patterns=[r'__pycache__', r'\.pyc$'])
+
+    # then
+    assert result == {'agents': ['plugin.py']}
+    assert str(tmpdir.join('agents', '__pycache__')) not in scanned
+
+
+def test_find_files_with_exclude_patterns_using_backreferences(tmpdir):
+    # given
+    tmpdir.join('agents', 'foo_foo').write_binary(b'hello', ensure=True)
+    tmpdir.join('agents', 'foo_bar').write_binary(b'hello', ensure=True)
+
+    # when
+    result = mkp.find_files(str(tmpdir), exclude_patterns=[r'(ba)z', r'/(\w+)_\1$'])
+
+    # then
+    assert result == {'agents': ['foo_bar']}
+
+
+def test_find_files_honors_mkpignore(tmpdir):
+    # given
+    tmpdir.join('.mkpignore').write_text(u'*.pyc\n/agents/build/\nlocal_*\n!local_keep\n', 'utf-8')
+    tmpdir.join('agents', 'plugin.py').write_binary(b'hello', ensure=True)
+    tmpdir.join('agents', 'plugin.pyc').write_binary(b'hello', ensure=True)
+    tmpdir.join('agents', 'build', 'artifact').write_binary(b'hello', ensure=True)
+    tmpdir.join('checks', 'build', 'foo').write_binary(b'hello', ensure=True)
+    tmpdir.join('checks', 'local_foo').write_binary(b'hello', ensure=True)
+    tmpdir.join('checks', 'local_keep').write_binary(b'hello', ensure=True)
+
+    # when
+    result = mkp.find_files(str(tmpdir))
+
+    # then
+    assert result == {'agents': ['plugin.py'], 'checks': ['local_keep', 'build/foo']}
+
+
+def test_find_files_with_include_all_skips_directories_ignored_by_mkpignore(tmpdir):
+    # given
+    tmpdir.join('.mkpignore').write_text(u'node_modules/\n', 'utf-8')
+    tmpdir.join('custom_dir', 'test').write_binary(b'Foo', ensure=True)
+    tmpdir.join('node_modules', 'test').write_binary(b'Foo', ensure=True)
+
+    # when
+    result = mkp.find_files(str(tmpdir), directories=mkp.INCLUDE_ALL)
+
+    # then
+    assert result == {'custom_dir': ['test']}
+
+
+@pytest.mark.parametrize('directories', [DIRECTORIES, mkp.INCLUDE_ALL])
+def test_find_files_with_concurrent_discovery_matches_sequential_discovery(tmpdir, directories):
+    # given
+    tmpdir.join('.mkpignore').write_text(u'ignored_*\n', 'utf-8')
+    for directory in ['agents', 'checks', 'mibs', 'custom_dir']:
+        for name in ['b/y/z', 'b/x', 'a/z', 'd', 'c', 'ignored_file', 'ignored_dir/file', '.hidden/file']:
+            tmpdir.join(directory, name).write_binary(b'hello', ensure=True)
+
+    # when
+    sequential = mkp.find_files(str(tmpdir), directories=directories, exclude_patterns=[r'/d$'])
+    concurrent = mkp.find_files(str(tmpdir), directories=directories, exclude_patterns=[r'/d$'], jobs=4)
+
+    # then
+    assert concurrent == sequential
+    assert list(concurrent.keys()) == list(sequential.keys())
+    assert concurrent['agents'] == ['c', 'a/z', 'b/x', 'b/y/z']
+
+
+def test_pack_to_bytes_creates_headers_for_links_without_name_lookups(tmpdir, monkeypatch):
+    # given
+    tmpdir.join('agents', 'agent').write_binary(b'hello', ensure=True)
+    tmpdir.join('agents', 'agent').chmod(0o750)
+    os.link(str(tmpdir.join('agents', 'agent')), str(tmpdir.join('agents', 'agent_hardlink')))
+    os.symlink('agent', str(tmpdir.join('agents', 'agent_symlink')))
+    info = {'files': mkp.find_files(str(tmpdir))}
+    monkeypatch.setattr(tarfile, 'pwd', None)
+    monkeypatch.setattr(tarfile, 'grp', None)
+
+    # when
+    data = mkp.pack_to_bytes(info, str(tmpdir))
+
+    # then
+    archive = tarfile.open(fileobj=io.BytesIO(data))
+    agents_archive = tarfile.open(fileobj=archive.extractfile('agents.tar'), mode='r:')
+    agent = agents_archive.getmember('agent')
+    assert agent.isreg() and agent.mode == 0o750 and agent.size == 5
+    assert agent.mtime == int(tmpdir.join('agents', 'agent').mtime())
+    assert agents_archive.extractfile('agent').read() == b'hello'
+    assert agents_archive.getmember('agent_hardlink').islnk()
+    assert agents_archive.getmember('agent_hardlink').linkname == 'agent'
+    assert agents_archive.getmember('agent_symlink').issym()
+    assert agents_archive.getmember('agent_symlink').linkname == 'agent'
+
+
+def test_dist_does_not_stat_files_again_when_packing(tmpdir, sample_files, sample_info, monkeypatch):
+    # given
+    lstat_calls = []
+    lstat = os.lstat
+    monkeypatch.setattr(os, 'lstat', lambda path, **kwargs: lstat_calls.append(path) or lstat(path, **kwargs))
+
+    # when
+    mkp.dist(sample_info, str(tmpdir))
+
+    # then
+    assert not any(str(path).startswith(str(tmpdir.join('agents'))) for path in lstat_calls)
+    assert not any(str(path).startswith(str(tmpdir.join('checks'))) for path in lstat_calls)
+
+
+def _unsupported(*args):
+    raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+
+@pytest.mark.parametrize('copy_file_range, sendfile', [
+    (None, None),
+    (_unsupported, None),
+    (_unsupported, os.sendfile),
+    (getattr(os, 'copy_file_range', _unsupported), os.sendfile),
+])
+def test_pack_to_bytes_copies_large_files(tmpdir, monkeypatch, copy_file_range, sendfile):
+    # given
+    monkeypatch.setattr(mkp, '_SPOOL_MAX_SIZE', 4096)
+    monkeypatch.setattr(mkp, '_LARGE_FILE_SIZE', 2048)
+    monkeypatch.setattr(mkp, '_COPY_BUFFER_SIZE', 1000)
+    monkeypatch.setattr(mkp, '_copy_buffers', threading.local())
+    for name, function in [('copy_file_range', copy_file_range), ('sendfile', sendfile)]:
+        if function is None:
+            monkeypatch.delattr(os, name, raising=False)
+        else:
+            monkeypatch.setattr(os, name, function, raising=False)
+    payloads = {'small': b'hello', 'medium': bytes(range(256)) * 12 + b'x', 'large': bytes(range(256)) * 40 + b'y'}
+    for name, payload in payloads.items():
+        tmpdir.join('agents', name).write_binary(payload, ensure=True)
+    info = {'files': {'agents': ['large', 'medium', 'small']}}
+
+    # when
+    data = mkp.pack_to_bytes(info, str(tmpdir))
+
+    # then
+    archive = tarfile.open(fileobj=io.BytesIO(data))
+    agents_archive = tarfile.open(fileobj=archive.extractfile('agents.tar'), mode='r:')
+    assert agents_archive.getnames() == ['large', 'medium', 'small']
+    for name, payload in payloads.items():
+        assert agents_archive.extractfile(name).read() == payload
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+@pytest.mark.parametrize('cache', [False, True])
+def test_dist_with_pipeline_writes_the_same_package_as_sequential_mode(tmpdir, sample_files, sample_info, monkeypatch,
+                                                                        jobs, cache):
+    # given
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1234567890')
+    tmpdir.join('checks', 'bar').write_binary(bytes(range(256)) * 4096, ensure=True)
+    tmpdir.join('web', 'plugins', 'baz').write_binary(b'Web', ensure=True)
+    mkp.dist(dict(sample_info), str(tmpdir), jobs=jobs, cache=cache, reproducible=True)
+    expected = tmpdir.join('dist', 'foo-42.mkp').read_binary()
+
+    # when
+    mkp.dist(dict(sample_info), str(tmpdir), jobs=jobs, cache=cache, reproducible=True, pipeline=True)
+
+    # then
+    assert tmpdir.join('dist', 'foo-42.mkp').read_binary() == expected
+
+
+def test_dist_with_pipeline(tmpdir, sample_files, sample_info):
+    # when
+    mkp.dist(sample_info, str(tmpdir), pipeline=True)
+
+    # then
+    package = mkp.load_file(str(tmpdir.join('dist', 'foo-42.mkp')))
+    assert package.info['files'] == {'agents': ['special/agent_test'], 'checks': ['foo']}
+    assert package.info['num_files'] == 2
+    assert package.json_info == package.info
+
+
+def test_pack_with_pipeline_builds_archives_and_compresses_in_separate_threads(tmpdir, sample_files, monkeypatch):
+    # given
+    builders = []
+    writers = []
+    create_directory_archive = mkp._create_directory_archive
+    monkeypatch.setattr(mkp, '_create_directory_archive', lambda *args: builders.append(threading.current_thread())
+                        or create_directory_archive(*args))
+
+    class Target(io.RawIOBase):
+        def writable(self):
+            return True
+
+        def write(self, data):
+            writers.append(threading.current_thread())
+            return len(data)
+
+    info = {'name': 'foo', 'files': mkp.find_files(str(tmpdir))}
+
+    # when
+    mkp._pack(info, str(tmpdir), Target(), mkp._pack_options(1, None, False, pipeline=True))
+
+    # then
+    assert len(builders) == 2
+    assert threading.main_thread() not in builders
+    compressors = set(writers[1:]) - {threading.main_thread()}
+    assert compressors and not compressors & set(builders)
+
+
+def test_pack_with_pipeline_closes_built_archives_on_errors(tmpdir, sample_files, monkeypatch):
+    # given
+    archives = []
+    create_directory_archive = mkp._create_directory_archive
+
+    def create(*args):
+        archives.append(create_directory_archive(*args))
+        return archives[-1]
+
+    def fail(*args, **kwargs):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(mkp, '_create_directory_archive', create)
+    monkeypatch.setattr(mkp, '_add_file_to_archive', fail)
+    info = {'name': 'foo', 'files': mkp.find_files(str(tmpdir))}
+
+    # when
+    with pytest.raises(OSError, match='disk full'):
+        mkp._pack(info, str(tmpdir), io.BytesIO(), mkp._pack_options(1, None, False, pipeline=True))
+
+    # then
+    assert archives and all(archive.closed for archive in archives)
+
+
+def test_dist_with_pipeline_propagates_discovery_errors(tmpdir, sample_files, sample_info, monkeypatch):
+    # given
+    def fail(*args, **kwargs):
+        raise OSError('discovery failed')
+    monkeypatch.setattr(mkp, '_find_files_in_directory', fail)
+
+    # when / then
+    with pytest.raises(OSError, match='discovery failed'):
+        mkp.dist(sample_info, str(tmpdir), pipeline=True)
+
+
+@pytest.mark.parametrize('read_ahead, read_ahead_bytes', [(1, 1), (4, 100), (4, 1024 * 1024)])
+def test_pack_to_bytes_with_read_ahead_matches_packing_without(tmpdir, read_ahead, read_ahead_bytes):
+    # given
+    for i in range(50):
+        tmpdir.join('mibs', 'MIB-{:02}'.format(i)).write_binary(b'x' * i * 7, ensure=True)
+    tmpdir.join('mibs', 'link').mksymlinkto('MIB-01')
+    info = {'files': mkp.find_files(str(tmpdir))}
+    expected = mkp.pack_to_bytes(dict(info), str(tmpdir), reproducible=True)
+
+    # when
+    data = mkp.pack_to_bytes(dict(info), str(tmpdir), reproducible=True, read_ahead=read_ahead,
+                             read_ahead_bytes=read_ahead_bytes)
+
+    # then
+    assert data == expected
+
+
+def test_dist_with_read_ahead_reads_small_files_on_the_pool(tmpdir, sample_files, sample_info, monkeypatch):
+    # given
+    read = []
+    read_file = mkp._read_file
+    monkeypatch.setattr(mkp, '_read_file', lambda path: read.append(path) or read_file(path))
+
+    # when
+    mkp.dist(sample_info, str(tmpdir), read_ahead=2)
+
+    # then
+    assert sorted(read) == [str(tmpdir.join('agents', 'special', 'agent_test')), str(tmpdir.join('checks', 'foo'))]
+    package = mkp.load_file(str(tmpdir.join('dist', 'foo-42.mkp')))
+    package.extract_files(str(tmpdir.join('extracted')))
+    assert tmpdir.join('extracted', 'checks', 'foo').read_binary() == b'Check Me!'
+
+
+class CountingReader(io.RawIOBase):
+
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        length = self._data.readinto(buffer)
+        self.bytes_read += length
+        return length
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._data.seek(offset, whence)
+
+    def tell(self):
+        return self._data.tell()
+
+
+def _create_package(members):
+    bytes_io = io.BytesIO()
+    with tarfile.open(fileobj=bytes_io, mode='w:gz') as archive:
+        for name, content in members:
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(content)
+            archive.addfile(tarinfo, io.BytesIO(content))
+    return bytes_io.getvalue()
+
+
+def _pack_incompressible_package(tmpdir):
+    tmpdir.join('agents', 'noise').write_binary(os.urandom(4 * 1024 * 1024), ensure=True)
+    info = {'name': 'foo', 'version': '42', 'files': {'agents': ['noise']}}
+    return info, mkp.pack_to_bytes(info, str(tmpdir))
+
+
+def test_read_info(tmpdir, sample_files, sample_info):
+    # given
+    mkp.dist(sample_info, str(tmpdir))
+
+    # when
+    info = mkp.read_info(str(tmpdir.join('dist', 'foo-42.mkp')))
+
+    # then
+    assert info == mkp.load_file(str(tmpdir.join('dist', 'foo-42.mkp'))).info
+
+
+def test_package_in_lazy_mode_reads_only_the_metadata(tmpdir):
+    # given
+    info, data = _pack_incompressible_package(tmpdir)
+    reader = CountingReader(data)
+
+    # when
+    package = mkp.Package(reader, lazy=True)
+
+    # then
+    assert package.info['files'] == info['files']
+    assert package.json_info == package.info
+    assert reader.bytes_read < len(data) // 10
+
+
+def test_package_in_lazy_mode_opens_the_archive_on_first_access(tmpdir):
+    # given
+    _, data = _pack_incompressible_package(tmpdir)
+    package = mkp.load_bytes(data, lazy=True)
+
+    # when
+    package.extract_files(str(tmpdir.join('extracted')))
+
+    # then
+    assert tmpdir.join('extracted', 'agents', 'noise').read_binary() == tmpdir.join('agents', 'noise').read_binary()
+    assert package.archive.getnames() == ['info', 'info.json', 'agents.tar']
+
+
+@pytest.mark.parametrize('members', [
+    ['checks.tar', 'info.json', 'info'],
+    ['info', 'checks.tar'],
+])
+def test_read_info_scans_packages_with_a_different_member_order(tmpdir, members):
+    # given
+    contents = {
+        'info': mkp.encode_info({'name': 'foreign'}),
+        'info.json': mkp.encode_info_json({'name': 'foreign'}),
+        'checks.tar': b'\0' * 1024,
+    }
+    data = _create_package([(name, contents[name]) for name in members])
+    tmpdir.join('foreign.mkp').write_binary(data)
+
+    # when
+    info = mkp.read_info(str(tmpdir.join('foreign.mkp')))
+    package = mkp.load_bytes(data, lazy=True)
+
+    # then
+    assert info == {'name': 'foreign'}
+    assert package.json_info == ({'name': 'foreign'} if 'info.json' in members else None)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_package_prefers_info_json(lazy):
+    # given
+    data = _create_package([
+        ('info', b"{'name': 'foo', 'version': (1, 0)}"),
+        ('info.json', b'{"name": "foo", "version": [1, 0]}'),
+    ])
+
+    # when
+    package = mkp.load_bytes(data, lazy=lazy, verify_info=True)
+
+    # then
+    assert package.info == {'name': 'foo', 'version': [1, 0]}
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_package_with_verify_info_rejects_info_json_not_matching_info(lazy):
+    # given
+    data = _create_package([
+        ('info', b"{'name': 'foo'}"),
+        ('info.json', b'{"name": "bar"}'),
+    ])
+
+    # when / then
+    assert mkp.load_bytes(data, lazy=lazy).info == {'name': 'bar'}
+    with pytest.raises(ValueError, match='does not match'):
+        mkp.load_bytes(data, lazy=lazy, verify_info=True)
+
+
+def test_package_decodes_info_without_info_json():
+    # given
+    data = _create_package([('info', b"{'name': 'foo',\n 'title': ('wrapped '\n           'title')}")])
+
+    # when
+    package = mkp.load_bytes(data)
+
+    # then
+    assert package.info == {'name': 'foo', 'title': 'wrapped title'}
+    assert package.json_info is None
+
+
+def test_encode_info_writes_a_sorted_python_literal():
+    # given
+    info = {
+        'version': '1.0',
+        'name': 'foo',
+        'files': {'web': ['b', 'a'], 'checks': ["it's", 'café\n']},
+        'num_files': 4,
+        'version.usable_until': None,
+        'nested': [{'z': 1, 'a': (2.5, True)}],
+    }
+
+    # when
+    encoded = mkp.encode_info(info)
+
+    # then
+    assert encoded.decode().splitlines()[0] == "{'files': {'checks': [\"it's\", 'café\\n'], 'web': ['b', 'a']},"
+    assert ast.literal_eval(encoded.decode()) == info
+    assert mkp.decode_info(encoded) == info
+    assert mkp.encode_info(dict(reversed(list(info.items())))) == encoded
+    assert list(ast.literal_eval(encoded.decode())['nested'][0]) == ['a', 'z']
+
+
+def test_pack_to_bytes_writes_the_same_info_as_encode_info(tmpdir):
+    # given
+    tmpdir.join('checks', 'foo').write_binary(b'Check Me!', ensure=True)
+    info = {'name': 'foo', 'files': {'checks': ['foo']}}
+
+    # when
+    data = mkp.pack_to_bytes(info, str(tmpdir))
+
+    # then
+    archive = tarfile.open(fileobj=io.BytesIO(data))
+    assert archive.extractfile('info').read() == mkp.encode_info(info)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+@pytest.mark.parametrize('lazy', [False, True])
+def test_load_file_as_context_manager_closes_the_file(tmpdir, sample_files, sample_info, monkeypatch, use_mmap,
+                                                      lazy):
+    # given
+    mkp.dist(sample_info, str(tmpdir))
+    opened = []
+    original_open = open
+
+    def tracking_open(*args, **kwargs):
+        f = original_open(*args, **kwargs)
+        opened.append(f)
+        return f
+    monkeypatch.setattr('builtins.open', tracking_open)
+
+    # when
+    try:
+        with mkp.load_file(str(tmpdir.join('dist', 'foo-42.mkp')), lazy=lazy, use_mmap=use_mmap) as package:
+            package.extract_files(str(tmpdir.join('extracted')))
+    finally:
+        monkeypatch.undo()
+
+    # then
+    assert package.info['name'] == 'foo'
+    assert tmpdir.join('extracted', 'checks', 'foo').read_binary() == b'Check Me!'
+    assert len(opened) == 1 and opened[0].closed
+
+
+@pytest.mark.parametrize('convert', [bytearray, memoryview, lambda data: memoryview(bytearray(data))])
+def test_load_bytes_accepts_bytes_like_objects(tmpdir, sample_files, sample_info, convert):
+    # given
+    mkp.dist(sample_info, str(tmpdir))
+    data = convert(tmpdir.join('dist', 'foo-42.mkp').read_binary())
+
+    # when
+    with mkp.load_bytes(data) as package:
+        package.extract_files(str(tmpdir.join('extracted')))
+
+    # then
+    assert package.info['name'] == 'foo'
+    assert tmpdir.join('extracted', 'checks', 'foo').read_binary() == b'Check Me!'
+    if isinstance(data, bytearray):
+        data.append(0)  # fails if a view of data is still exported
+
+
+@pytest.fixture
+def package_with_links(tmpdir):
+    tmpdir.join('src', 'agents', 'plugins', 'foo').write_binary(b'Foo', ensure=True)
+    tmpdir.join('src', 'agents', 'big').write_binary(bytes(range(256)) * 1000, ensure=True)
+    os.link(str(tmpdir.join('src', 'agents', 'plugins', 'foo')), str(tmpdir.join('src', 'agents', 'hardlink')))
+    tmpdir.join('src', 'agents', 'plugins', 'symlink').mksymlinkto('foo')
+    tmpdir.join('src', 'checkman', 'foo').write_binary(b'title: Foo', ensure=True)
+    info = {'name': 'foo', 'files': mkp.find_files(str(tmpdir.join('src')))}
+    return mkp.pack_to_bytes(info, str(tmpdir.join('src')))
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_package_reads_single_files(package_with_links, monkeypatch, lazy):
+    # given
+    indexed = []
+    index_directory_members = mkp._index_directory_members
+    monkeypatch.setattr(mkp, '_index_directory_members',
+                        lambda stream: indexed.append(stream) or index_directory_members(stream))
+    package = mkp.load_bytes(package_with_links, lazy=lazy)
+
+    # when / then
+    assert package.read('checkman', 'foo') == b'title: Foo'
+    assert package.read('agents', 'plugins/foo') == b'Foo'
+    assert package.read('agents', 'hardlink') == b'Foo'
+    assert package.read('agents', 'plugins/symlink') == b'Foo'
+    assert package.read('agents', 'big') == bytes(range(256)) * 1000
+    assert len(indexed) == 1
+
+
+def test_package_open_returns_a_seekable_file(package_with_links):
+    # given
+    package = mkp.load_bytes(package_with_links)
+
+    # when
+    with package.open('agents', 'big') as f:
+        f.seek(1000)
+        head = f.read(24)
+        f.seek(-4, io.SEEK_END)
+        tail = f.read()
+
+    # then
+    assert head == (bytes(range(256)) * 1000)[1000:1024]
+    assert tail == bytes(range(252, 256))
+
+
+@pytest.mark.parametrize('directory, relpath', [('agents', 'missing'), ('checks', 'foo'), ('agents', 'plugins')])
+def test_package_read_raises_key_error_for_missing_files(package_with_links, directory, relpath):
+    # given
+    package = mkp.load_bytes(package_with_links)
+
+    # when / then
+    with pytest.raises(KeyError):
+        package.read(directory, relpath)
+
+
+def test_indexed_gzip_reader_seeks_in_the_uncompressed_data():
+    # given
+    data = os.urandom(200000) + bytes(range(256)) * 4000 + os.urandom(100000)
+    compressed = gzip.compress(data[:1000]) + gzip.compress(data[1000:])
+    reader = mkp.IndexedGzipReader(io.BytesIO(compressed), spacing=64 * 1024)
+
+    # when / then
+    assert reader.read() == data
+    for offset, size in [(0, 10), (len(data) - 5, 10), (999, 2), (150000, 300000), (len(data) + 1, 1), (500, 0)]:
+        reader.seek(offset)
+        assert reader.read(size) == data[offset:offset + size]
+    assert reader.seek(0, io.SEEK_END) == len(data)
+
+
+def test_indexed_gzip_reader_rejects_uncompressed_data():
+    with pytest.raises(ValueError):
+        mkp.IndexedGzipReader(io.BytesIO(b'info'))
+
+
+def test_indexed_package_decompresses_from_the_closest_checkpoint(tmpdir):
+    # given
+    _, data = _pack_incompressible_package(tmpdir)
+    noise = tmpdir.join('agents', 'noise').read_binary()
+    reader = CountingReader(data)
+    package = mkp.Package(reader, indexed=True)
+    package.read('agents', 'noise')
+
+    # when
+    bytes_read = reader.bytes_read
+    with package.open('agents', 'noise') as f:
+        f.seek(3 * 1024 * 1024)
+        chunk = f.read(1024)
+
+    # then
+    assert chunk == noise[3 * 1024 * 1024:3 * 1024 * 1024 + 1024]
+    assert reader.bytes_read - bytes_read < len(data) // 3
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_indexed_package_extracts_files(tmpdir, lazy):
+    # given
+    _, data = _pack_incompressible_package(tmpdir)
+
+    # when
+    with mkp.load_bytes(data, lazy=lazy, indexed=True) as package:
+        package.extract_files(str(tmpdir.join('extracted')))
+
+    # then
+    assert tmpdir.join('extracted', 'agents', 'noise').read_binary() == tmpdir.join('agents', 'noise').read_binary()
+
+
+class StreamReader(io.RawIOBase):
+
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self._data.readinto(buffer)
+
+
+def test_iter_files_reads_a_non_seekable_stream(package_with_links):
+    # when
+    files = {(directory, relpath): (tarinfo, f.read() if f else None)
+             for directory, relpath, tarinfo, f in mkp.iter_files(StreamReader(package_with_links))}
+
+    # then
+    assert files[('agents', 'big')][1] == bytes(range(256)) * 1000
+    assert files[('checkman', 'foo')][1] == b'title: Foo'
+    tarinfo, content = files[('agents', 'plugins/symlink')]
+    assert tarinfo.issym() and tarinfo.linkname == 'foo' and content is None
+    assert set(files) == set(mkp.load_bytes(package_with_links).manifest)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_package_iter_files_decompresses_the_package_once(tmpdir, lazy):
+    # given
+    _, data = _pack_incompressible_package(tmpdir)
+    reader = CountingReader(data)
+    package = mkp.Package(reader, lazy=lazy)
+    bytes_read = reader.bytes_read
+
+    # when
+    files = [(directory, relpath, f.read()) for directory, relpath, _, f in package.iter_files()]
+
+    # then
+    assert files == [('agents', 'noise', tmpdir.join('agents', 'noise').read_binary())]
+    assert reader.bytes_read - bytes_read <= len(data)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_extract_files_decompresses_the_package_once(tmpdir, lazy):
+    # given
+    for directory in ['agents', 'checks', 'web']:
+        tmpdir.join('src', directory, 'noise').write_binary(os.urandom(1024 * 1024), ensure=True)
+        tmpdir.join('src', directory, 'sub', 'foo').write_binary(directory.encode(), ensure=True)
+    info = {'name': 'foo', 'files': mkp.find_files(str(tmpdir.join('src')))}
+    reader = CountingReader(mkp.pack_to_bytes(info, str(tmpdir.join('src'))))
+
+    # when
+    mkp.Package(reader, lazy=lazy).extract_files(str(tmpdir.join('extracted')))
+
+    # then
+    assert reader.bytes_read < 1.1 * len(reader._data.getvalue())
+    for directory in ['agents', 'checks', 'web']:
+        for relpath in ['noise', 'sub/foo']:
+            assert tmpdir.join('extracted', directory, relpath).read_binary() == \
+                tmpdir.join('src', directory, relpath).read_binary()
+
+
+def test_extract_files_extracts_links(tmpdir, package_with_links):
+    # when
+    mkp.load_bytes(package_with_links).extract_files(str(tmpdir.join('extracted')))
+
+    # then
+    assert tmpdir.join('extracted', 'agents', 'hardlink').read_binary() == b'Foo'
+    assert tmpdir.join('extracted', 'agents', 'plugins', 'foo').read_binary() == b'Foo'
+    assert tmpdir.join('extracted', 'agents', 'plugins', 'symlink').readlink() == 'foo'
+
+
+def test_extract_files_fails_for_missing_directory_archives(tmpdir):
+    # given
+    info = {'name': 'foo', 'files': {'checks': ['foo']}}
+    data = _create_package([('info', mkp.encode_info(info)), ('agents.tar', b'\0' * 1024)])
+
+    # when / then
+    with pytest.raises(KeyError):
+        mkp.load_bytes(data).extract_files(str(tmpdir.join('extracted')))
@@ -0,0 +1,118 @@
+import errno
+import threading
+import time
+
+import pytest
+
+import mkp
+from mkp._watch import _InotifyWatcher, wait_for_changes
+
+
+def _write_later(path, data, delay=0.3):
+    timer = threading.Timer(delay, lambda: path.write_binary(data, ensure=True))
+    timer.start()
+    return timer
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_wait_for_changes_reports_changed_directories(tmpdir, use_inotify):
+    # given
+    tmpdir.join('agents', 'test').write_binary(b'Foo', ensure=True)
+    tmpdir.join('checks', 'test').write_binary(b'Foo', ensure=True)
+    changes = wait_for_changes(str(tmpdir), ['agents', 'checks'], excluded=set(), debounce=0.2,
+                               poll_interval=0.05, use_inotify=use_inotify)
+
+    # when
+    timer = _write_later(tmpdir.join('checks', 'sub', 'new'), b'Bar')
+    changed = next(changes)
+    timer.join()
+    changes.close()
+
+    # then
+    assert changed == {'checks'}
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_wait_for_changes_ignores_hidden_files_and_excluded_directories(tmpdir, use_inotify):
+    # given
+    tmpdir.join('agents', 'test').write_binary(b'Foo', ensure=True)
+    tmpdir.join('dist').mkdir()
+    changes = wait_for_changes(str(tmpdir), None, excluded={'dist'}, debounce=0.2, poll_interval=0.05,
+                               use_inotify=use_inotify)
+
+    # when
+    timers = [
+        _write_later(tmpdir.join('agents', '.test.swp'), b'Bar', delay=0.1),
+        _write_later(tmpdir.join('dist', 'foo-42.mkp'), b'Bar', delay=0.1),
+        _write_later(tmpdir.join('custom_dir', 'test'), b'Bar', delay=0.5),
+    ]
+    changed = next(changes)
+    for timer in timers:
+        timer.join()
+    changes.close()
+
+    # then
+    assert changed == {'custom_dir'}
+
+
+def test_dist_in_watch_mode_rebuilds_after_changes(tmpdir, monkeypatch):
+    # given
+    tmpdir.join('checks', 'foo').write_binary(b'Check Me!', ensure=True)
+
+    def fake_wait_for_changes(path, directories, excluded, debounce, poll_interval):
+        tmpdir.join('checks', 'bar').write_binary(b'New check')
+        yield {'checks'}
+
+    monkeypatch.setattr(mkp, 'wait_for_changes', fake_wait_for_changes)
+
+    # when
+    mkp.dist({'name': 'foo', 'version': '42'}, str(tmpdir), watch=True)
+
+    # then
+    package = mkp.load_file(str(tmpdir.join('dist', 'foo-42.mkp')))
+    assert sorted(package.info['files']['checks']) == ['bar', 'foo']
+    assert tmpdir.join('dist', '.cache').exists()
+
+
+def _fail_to_add_watch(*args):
+    raise OSError(errno.ENOSPC, 'inotify_add_watch failed')
+
+
+def test_wait_for_changes_falls_back_to_polling_if_inotify_watches_cannot_be_added(tmpdir, monkeypatch):
+    # given
+    tmpdir.join('checks', 'test').write_binary(b'Foo', ensure=True)
+    monkeypatch.setattr(_InotifyWatcher, '_add_watch', _fail_to_add_watch)
+    changes = wait_for_changes(str(tmpdir), ['checks'], excluded=set(), debounce=0.2, poll_interval=0.05)
+
+    # when
+    timer = _write_later(tmpdir.join('checks', 'new'), b'Bar')
+    changed = next(changes)
+    timer.join()
+    changes.close()
+
+    # then
+    assert changed == {'checks'}
+
+
+def test_wait_for_changes_switches_to_polling_if_a_new_directory_cannot_be_watched(tmpdir, monkeypatch):
+    # given
+    tmpdir.join('agents', 'test').write_binary(b'Foo', ensure=True)
+    tmpdir.join('checks', 'test').write_binary(b'Foo', ensure=True)
+    changes = wait_for_changes(str(tmpdir), ['agents', 'checks'], excluded=set(), debounce=0.2, poll_interval=0.05)
+    next_changes = threading.Thread(target=lambda: results.append(next(changes)))
+    results = []
+    next_changes.start()
+    time.sleep(0.2)
+    monkeypatch.setattr(_InotifyWatcher, '_add_watch', _fail_to_add_watch)
+
+    # when
+    tmpdir.join('checks', 'sub', 'new').write_binary(b'Bar', ensure=True)
+    next_changes.join(5)
+    timer = _write_later(tmpdir.join('agents', 'test'), b'Changed')
+    later = next(changes)
+    timer.join()
+    changes.close()
+
+    # then
+    assert results == [{'agents', 'checks'}]
+    assert later == {'agents'}